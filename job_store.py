@@ -0,0 +1,142 @@
+"""
+SQLite-backed persistence for job tracking metadata
+Lets the API look up jobs that were evicted from the in-memory cache
+"""
+import json
+import sqlite3
+import threading
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Seconds a write waits for another process's lock on the database
+BUSY_TIMEOUT = 30
+
+class JobStore:
+    # Columns stored as JSON text
+    JSON_FIELDS = ("stems", "result", "supabase_urls", "stems_available")
+    FIELDS = ("job_id", "runpod_job_id", "stems", "status", "created_at",
+              "completed_at", "result", "error", "supabase_urls", "stems_available")
+
+    def __init__(self, db_path: str, tombstone_ttl: float = 24 * 3600):
+        """
+        Open (or create) the job database
+
+        Args:
+            db_path: Path to the SQLite database file
+            tombstone_ttl: Seconds a deleted job is remembered, so stale in-memory
+                copies in other processes are not saved back (at least their cache TTL)
+        """
+        self.db_path = str(db_path)
+        self.tombstone_ttl = tombstone_ttl
+        # Accessed from the event loop and from worker threads, so serialize with a lock
+        # Several API workers and the sync worker open the same file; the busy timeout makes a
+        # writer wait for another's lock instead of failing with "database is locked"
+        self.conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.lock = threading.Lock()
+        # WAL lets readers in other processes carry on while one of them writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    runpod_job_id TEXT,
+                    stems TEXT,
+                    status TEXT,
+                    created_at TEXT,
+                    completed_at TEXT,
+                    result TEXT,
+                    error TEXT,
+                    supabase_urls TEXT,
+                    stems_available TEXT
+                )
+                """
+            )
+            # Databases created before a column existed get it added (NULL for old rows)
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            for field in self.FIELDS:
+                if field not in columns:
+                    self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {field} TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            # Tombstones of deleted jobs
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS deleted_jobs (job_id TEXT PRIMARY KEY, deleted_at REAL)"
+            )
+
+        logger.info(f"Job store opened at {self.db_path}")
+
+    def save(self, record: Dict) -> bool:
+        """Insert or update a job record; returns False (and saves nothing) if the job was deleted"""
+        values = [
+            json.dumps(record.get(field)) if field in self.JSON_FIELDS else record.get(field)
+            for field in self.FIELDS
+        ]
+        placeholders = ", ".join("?" for _ in self.FIELDS)
+
+        # Checked in the same statement so a concurrent delete cannot be undone
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(self.FIELDS)}) SELECT {placeholders} "
+                "WHERE NOT EXISTS (SELECT 1 FROM deleted_jobs WHERE job_id = ?)",
+                values + [record["job_id"]]
+            )
+        return cursor.rowcount > 0
+
+    def load(self, job_id: str) -> Optional[Dict]:
+        """Return the stored record for a job, or None if unknown"""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return self._to_record(row)
+
+    def _to_record(self, row) -> Dict:
+        return {
+            field: json.loads(value) if field in self.JSON_FIELDS and value is not None else value
+            for field, value in zip(self.FIELDS, row)
+        }
+
+    def pending(self, statuses: Iterable[str]) -> List[Dict]:
+        """Return the records of all jobs whose status is one of statuses"""
+        statuses = list(statuses)
+        placeholders = ", ".join("?" for _ in statuses)
+
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE status IN ({placeholders})",
+                statuses
+            ).fetchall()
+
+        return [self._to_record(row) for row in rows]
+
+    def delete(self, job_id: str):
+        """Remove a job record and leave a tombstone so it is not saved again"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self.conn.execute("INSERT OR REPLACE INTO deleted_jobs VALUES (?, ?)", (job_id, now))
+            self.conn.execute("DELETE FROM deleted_jobs WHERE deleted_at < ?", (now - self.tombstone_ttl,))
+
+    def deleted(self, job_ids: Iterable[str]) -> Set[str]:
+        """Return which of job_ids have been deleted"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        placeholders = ", ".join("?" for _ in job_ids)
+
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT job_id FROM deleted_jobs WHERE job_id IN ({placeholders})",
+                job_ids
+            ).fetchall()
+
+        return {row[0] for row in rows}
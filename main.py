@@ -1,14 +1,27 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import uuid
 import asyncio
+import fcntl
+import time
+import hashlib
+import shutil
 from pathlib import Path
 from typing import List, Optional
 import logging
 from enum import Enum
 from datetime import datetime
+import orjson
+# Legacy stems arrive as multi-MB base64, so use pybase64's SIMD decoder when available
+try:
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+from cachetools import TTLCache
+
+from job_store import JobStore
 
 # Environment variables will be loaded from system or docker environment
 
@@ -26,12 +39,13 @@ except ImportError:
     RunPodClient = None
 
 try:
-    from supabase_integration import SupabaseStemStorage
+    from supabase_integration import SupabaseStemStorage, get_storage
     SUPABASE_AVAILABLE = True
 except ImportError:
     logger.warning("Supabase integration not available - stems will only be downloadable via API")
     SUPABASE_AVAILABLE = False
     SupabaseStemStorage = None
+    get_storage = None
 
 # Job status tracking (simplified for RunPod)
 class JobStatus(str, Enum):
@@ -41,6 +55,29 @@ class JobStatus(str, Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+# Statuses after which a job no longer changes
+FINISHED_STATUSES = {JobStatus.COMPLETED, JobStatus.FAILED}
+# Statuses the sync loop keeps polling
+PENDING_STATUSES = [JobStatus.SUBMITTED, JobStatus.IN_QUEUE, JobStatus.IN_PROGRESS]
+
+# RunPod job status -> our status; statuses not listed leave the job unchanged
+RUNPOD_STATUS_MAP = {
+    "IN_QUEUE": JobStatus.IN_QUEUE,
+    "IN_PROGRESS": JobStatus.IN_PROGRESS,
+    "COMPLETED": JobStatus.COMPLETED,
+    "FAILED": JobStatus.FAILED,
+    "CANCELLED": JobStatus.FAILED,
+    "TIMED_OUT": JobStatus.FAILED,
+}
+
+# Fixed fields of the /jobs/{job_id} response for each status
+STATUS_RESPONSE_FIELDS = {
+    JobStatus.SUBMITTED: {"message": "Job submitted to RunPod, waiting for processing to start"},
+    JobStatus.IN_QUEUE: {"message": "Job is queued in RunPod, waiting for available GPU"},
+    JobStatus.IN_PROGRESS: {"message": "Job is currently being processed on RunPod GPU"},
+    JobStatus.FAILED: {"message": "Job failed"},
+}
+
 class RunPodJob:
     def __init__(self, job_id: str, runpod_job_id: str, stems: list):
         self.job_id = job_id
@@ -49,19 +86,141 @@ class RunPodJob:
         self.status = JobStatus.SUBMITTED
         self.created_at = datetime.now()
         self.completed_at = None
+        # ISO strings are formatted once instead of on every status request
+        self.created_at_iso = self.created_at.isoformat()
+        self.completed_at_iso = None
         self.result = None
         self.error = None
         self.supabase_urls = None  # Will store Supabase URLs when uploaded
+        self.upload_task = None  # background Supabase upload for base64 results
+        self.stems_available = []  # stem names in the result, computed once on completion
+        # Polling state used by sync_runpod_jobs
+        self.stable_ticks = 0  # consecutive polls that saw no status change
+        self.next_poll_at = 0.0  # monotonic deadline for the next status poll
+        # Serialized GET /jobs/{job_id} body, reused until the sync loop records a change
+        self.cached_response = None
+        self.cached_state = None
+    
+    def mark_completed(self):
+        """Record the time the job reached a finished state"""
+        self.completed_at = datetime.now()
+        self.completed_at_iso = self.completed_at.isoformat()
+    
+    def to_record(self) -> dict:
+        """Serialize the job metadata for the job store (base64 stems are not persisted)"""
+        result = None
+        if self.result:
+            result = {k: v for k, v in self.result.items() if k != "stems"}
+        return {
+            "job_id": self.job_id,
+            "runpod_job_id": self.runpod_job_id,
+            "stems": self.stems,
+            "status": self.status.value,
+            "created_at": self.created_at_iso,
+            "completed_at": self.completed_at_iso,
+            "result": result,
+            "error": self.error,
+            "supabase_urls": self.supabase_urls,
+            # Base64 stems spilled to disk are only known by name from here
+            "stems_available": self.stems_available
+        }
+    
+    @classmethod
+    def from_record(cls, record: dict) -> "RunPodJob":
+        """Rebuild a job from a job store record"""
+        job = cls(record["job_id"], record["runpod_job_id"], record["stems"])
+        job.status = JobStatus(record["status"])
+        job.created_at = datetime.fromisoformat(record["created_at"])
+        job.created_at_iso = record["created_at"]
+        if record["completed_at"]:
+            job.completed_at = datetime.fromisoformat(record["completed_at"])
+            job.completed_at_iso = record["completed_at"]
+        job.result = record["result"]
+        job.error = record["error"]
+        job.supabase_urls = record["supabase_urls"]
+        job.stems_available = record.get("stems_available") or list((job.supabase_urls or {}).keys())
+        if not job.stems_available and job.status == JobStatus.COMPLETED:
+            # Saved before stems_available was stored: fall back to the spilled base64 stems
+            job.stems_available = [path.stem for path in (OUTPUT_DIR / job.job_id).glob("*.wav")]
+        return job
+
+# Job tracking: bounded in-memory cache, backed by the job store for evicted jobs
+ACTIVE_JOBS_MAX = int(os.environ.get("ACTIVE_JOBS_MAX", 10000))
+ACTIVE_JOBS_TTL = int(os.environ.get("ACTIVE_JOBS_TTL", 24 * 3600))
+active_jobs = TTLCache(maxsize=ACTIVE_JOBS_MAX, ttl=ACTIVE_JOBS_TTL)  # job_id -> RunPodJob
+
+# RunPod status polling
+BASE_POLL_INTERVAL = 1  # seconds between polls of a job whose status just changed
+MAX_POLL_INTERVAL = 15  # upper bound for the per-job backoff
+JOB_RESPONSE_MAX_AGE = 2  # seconds clients may reuse a /jobs/{job_id} response
+
+# Set when a job is added so an idle sync loop wakes up immediately
+job_wakeup = asyncio.Event()
 
-# Job tracking
-active_jobs = {}  # job_id -> RunPodJob
+# "inline" polls RunPod from one API worker; "external" leaves it to runpod_sync.py
+RUNPOD_SYNC_MODE = os.environ.get("RUNPOD_SYNC_MODE", "inline").lower()
+# Other processes only submit or delete jobs when several API workers share the store or sync runs separately
+SHARED_JOB_STORE = RUNPOD_SYNC_MODE == "external" or int(os.environ.get("WEB_CONCURRENCY", 1)) > 1
+# Seconds between job store scans for jobs other processes submitted or deleted
+STORE_SYNC_INTERVAL = float(os.environ.get("STORE_SYNC_INTERVAL", 2))
+
+# Base64 stems are decoded in slices; a multiple of 4 so every slice decodes on its own
+B64_CHUNK_SIZE = 64 * 1024
+
+# The RunPod handler uploads stems itself and returns URLs; re-uploading base64
+# results from this service is only for old handler deployments
+LEGACY_BASE64_UPLOAD = os.environ.get("LEGACY_BASE64_UPLOAD", "false").lower() == "true"
+
+# Uploads are rejected up front when larger than this or not recognisable as audio
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 500 * 1024 * 1024))
+AUDIO_SNIFF_BYTES = 12
+# Container signatures of formats the worker's FFmpeg decoder reads; anything else
+# labelled audio/* is rejected, so extend this when a new format must be accepted
+AUDIO_MAGIC = (
+    (0, b"RIFF"),          # WAV
+    (0, b"RF64"),          # WAV over 4 GiB
+    (0, b"ID3"),           # MP3 (or AAC) with ID3 tag
+    (0, b"\xff\xfb"),      # MP3 frame sync (MPEG-1 Layer III)
+    (0, b"\xff\xfa"),      # MP3 frame sync (MPEG-1 Layer III, CRC)
+    (0, b"\xff\xf3"),      # MP3 frame sync (MPEG-2 Layer III)
+    (0, b"\xff\xf2"),      # MP3 frame sync (MPEG-2 Layer III, CRC)
+    (0, b"\xff\xe3"),      # MP3 frame sync (MPEG-2.5 Layer III)
+    (0, b"\xff\xe2"),      # MP3 frame sync (MPEG-2.5 Layer III, CRC)
+    (0, b"\xff\xfd"),      # MP2 frame sync (MPEG-1 Layer II)
+    (0, b"\xff\xfc"),      # MP2 frame sync (MPEG-1 Layer II, CRC)
+    (0, b"\xff\xf1"),      # ADTS AAC (MPEG-4)
+    (0, b"\xff\xf0"),      # ADTS AAC (MPEG-4, CRC)
+    (0, b"\xff\xf9"),      # ADTS AAC (MPEG-2)
+    (0, b"\xff\xf8"),      # ADTS AAC (MPEG-2, CRC)
+    (0, b"fLaC"),          # FLAC
+    (0, b"OggS"),          # Ogg Vorbis/Opus/FLAC
+    (4, b"ftyp"),          # MP4/M4A
+    (0, b"FORM"),          # AIFF
+    (0, b"\x1a\x45\xdf\xa3"),  # WebM/Matroska
+    (0, b"caff"),          # Core Audio Format
+    (0, b"\x30\x26\xb2\x75"),  # ASF (WMA)
+    (0, b"#!AMR"),         # AMR
+)
 
 app = FastAPI(
     title="STEMI Separation Service",
     description="GPU-accelerated stem separation using Demucs",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject oversized uploads from the Content-Length header before the body is read"""
+    if request.method == "POST" and request.url.path == "/separate":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            return ORJSONResponse(
+                status_code=413,
+                content={"detail": f"File too large - maximum upload size is {MAX_UPLOAD_BYTES} bytes"}
+            )
+    return await call_next(request)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -76,44 +235,218 @@ runpod_client = None
 supabase_storage = None
 
 # Initialize directories (support both local and Docker environments)
-UPLOAD_DIR = Path("uploads") if not Path("/app").exists() else Path("/app/uploads")
-OUTPUT_DIR = Path("outputs") if not Path("/app").exists() else Path("/app/outputs")
+BASE_DIR = Path(os.getenv("STEMI_ROOT") or ("/app" if os.path.isdir("/app") else "."))
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", BASE_DIR / "uploads"))
+OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", BASE_DIR / "outputs"))
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Deleted jobs are remembered as long as another worker may still hold them in memory
+job_store = JobStore(os.environ.get("JOBS_DB_PATH", OUTPUT_DIR / "jobs.db"), tombstone_ttl=ACTIVE_JOBS_TTL)
+
+# Only one process per host polls RunPod; it owns the in-memory job state and
+# writes every change to the job store, which all other workers read from
+POLLER_LOCK_PATH = os.environ.get("POLLER_LOCK_PATH", f"{job_store.db_path}.lock")
+is_poller = False
+poller_lock_file = None
+
+def acquire_poller_lock() -> bool:
+    """Try to become the process that polls RunPod for this host"""
+    global poller_lock_file
+    lock_file = open(POLLER_LOCK_PATH, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    poller_lock_file = lock_file  # held open for the lifetime of the process
+    return True
+
+async def get_job(job_id: str) -> Optional[RunPodJob]:
+    """Look up a job in memory, rehydrating it from the job store if it was evicted"""
+    # Only the poller's in-memory copy is kept current; other workers read the store
+    job = active_jobs.get(job_id) if is_poller else None
+    if job is not None and await asyncio.to_thread(job_store.deleted, [job_id]):
+        # Deleted through another worker; treat it as gone here too
+        active_jobs.pop(job_id, None)
+        return None
+    if job is None:
+        record = await asyncio.to_thread(job_store.load, job_id)
+        if record:
+            job = RunPodJob.from_record(record)
+            if is_poller:
+                active_jobs[job_id] = job
+                if job.status not in FINISHED_STATUSES:
+                    job_wakeup.set()
+    return job
+
+async def save_job(job: RunPodJob):
+    """Persist a job, or stop tracking it if it was deleted through another worker"""
+    if not await asyncio.to_thread(job_store.save, job.to_record()):
+        active_jobs.pop(job.job_id, None)
+        logger.info(f"Job {job.job_id} was deleted, no longer tracking it")
+
+async def adopt_pending_jobs():
+    """Start tracking pending jobs from the job store (after a restart or submitted by other workers), dropping deleted ones"""
+    records = await asyncio.to_thread(job_store.pending, [status.value for status in PENDING_STATUSES])
+    for record in records:
+        if record["job_id"] not in active_jobs:
+            active_jobs[record["job_id"]] = RunPodJob.from_record(record)
+    
+    # Stop polling jobs deleted through other workers
+    pending_ids = [job.job_id for job in active_jobs.values() if job.status in PENDING_STATUSES]
+    for job_id in await asyncio.to_thread(job_store.deleted, pending_ids):
+        active_jobs.pop(job_id, None)
+
+def store_sync_timeout(next_store_sync: float, deadline: float = float("inf")) -> Optional[float]:
+    """Seconds the sync loop may sleep before a job is due or the store is scanned again (None: until woken)"""
+    wake_at = min(deadline, next_store_sync)
+    return None if wake_at == float("inf") else max(0, wake_at - time.monotonic())
+
+def iter_b64_decode(data: str, chunk_size: int = B64_CHUNK_SIZE):
+    """Decode a base64 string slice by slice without materializing the whole payload"""
+    for i in range(0, len(data), chunk_size):
+        yield b64decode(data[i:i + chunk_size])
+
+def is_audio_header(header: bytes) -> bool:
+    """Check the first bytes of an upload against known audio container signatures"""
+    return any(header[offset:offset + len(magic)] == magic for offset, magic in AUDIO_MAGIC)
+
+def job_etag(job: RunPodJob) -> str:
+    """ETag for a job's status response; changes whenever the response content can change"""
+    state = f"{job.status.value}|{job.completed_at_iso}|{job.error}|{sorted((job.supabase_urls or {}).items())}"
+    return '"' + hashlib.md5(state.encode()).hexdigest() + '"'
+
+def job_poll_interval(job: RunPodJob) -> float:
+    """Seconds to wait before polling a job again, backing off while its status is unchanged"""
+    return min(MAX_POLL_INTERVAL, BASE_POLL_INTERVAL * 2 ** job.stable_ticks)
+
+async def fetch_job_statuses(jobs: List[RunPodJob]) -> List[dict]:
+    """Get RunPod statuses for jobs in one batch"""
+    # Jobs are only due BASE_POLL_INTERVAL or more after their last poll, so every response is fetched fresh
+    statuses = await runpod_client.get_job_statuses([job.runpod_job_id for job in jobs])
+    return [statuses[job.runpod_job_id] for job in jobs]
+
+def stem_file_path(job_id: str, stem: str) -> Path:
+    """Local path of a decoded stem spilled from a base64 result"""
+    return OUTPUT_DIR / job_id / f"{stem}.wav"
+
+def spill_stems(job: RunPodJob):
+    """Decode a job's base64 stems to its output directory and drop them from memory (blocking)"""
+    stems = job.result.pop("stems")
+    (OUTPUT_DIR / job.job_id).mkdir(exist_ok=True)
+    
+    for stem_name, stem_b64 in stems.items():
+        # Decode base64 in slices so the full stem bytes are never held
+        with open(stem_file_path(job.job_id, stem_name), "wb") as f:
+            for chunk in iter_b64_decode(stem_b64):
+                f.write(chunk)
+
+def upload_spilled_stems(job: RunPodJob) -> dict:
+    """Upload a job's spilled stems to Supabase (blocking)"""
+    stem_files = {}
+    try:
+        for stem_name in job.stems_available:
+            stem_files[stem_name] = open(stem_file_path(job.job_id, stem_name), "rb")
+        
+        # Upload to Supabase and get URLs
+        return supabase_storage.upload_stems_from_bytes(job.job_id, stem_files)
+    finally:
+        for stem_file in stem_files.values():
+            stem_file.close()
+
+async def upload_completed_stems(job: RunPodJob):
+    """Background task uploading a completed job's base64 stems to Supabase"""
+    try:
+        logger.info(f"Uploading base64 stems to Supabase for job {job.job_id}")
+        
+        urls = await asyncio.to_thread(upload_spilled_stems, job)
+        job.supabase_urls = urls
+        
+        # The local copies are no longer needed now that the stems live in Supabase
+        await asyncio.to_thread(shutil.rmtree, OUTPUT_DIR / job.job_id, ignore_errors=True)
+        job.cached_response = None
+        await save_job(job)
+        
+        logger.info(f"Successfully uploaded {len(urls)} stems to Supabase for job {job.job_id}")
+        
+    except Exception as e:
+        logger.error(f"Failed to upload stems to Supabase for job {job.job_id}: {e}")
+        # Don't fail the job, just log the error
+
+def schedule_input_cleanup(job_id: str):
+    """Remove a job's source audio from Supabase in the background once RunPod no longer needs it"""
+    if not supabase_storage:
+        return
+    
+    async def delete_input():
+        try:
+            await asyncio.to_thread(supabase_storage.delete_input, job_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete input audio for job {job_id}: {e}")
+    
+    asyncio.create_task(delete_input())
+
 async def sync_runpod_jobs():
     """Background task to sync RunPod job statuses"""
+    next_store_sync = 0.0  # the first pass adopts jobs left pending by a previous run
     while True:
         try:
             if not runpod_client:
                 await asyncio.sleep(10)
                 continue
             
+            # Evict expired jobs; they stay available through the job store
+            active_jobs.expire()
+            # Scanning the store on every poll would query it once a second per in-flight job;
+            # with no other processes it is scanned once, at start
+            if time.monotonic() >= next_store_sync:
+                await adopt_pending_jobs()
+                next_store_sync = time.monotonic() + STORE_SYNC_INTERVAL if SHARED_JOB_STORE else float("inf")
+            
             # Check status of all pending jobs
             pending_jobs = [job for job in active_jobs.values() 
-                          if job.status in [JobStatus.SUBMITTED, JobStatus.IN_QUEUE, JobStatus.IN_PROGRESS]]
+                          if job.status in PENDING_STATUSES]
+            
+            # Nothing to poll: sleep until a job is submitted here, or check the store again later
+            if not pending_jobs:
+                job_wakeup.clear()
+                try:
+                    await asyncio.wait_for(job_wakeup.wait(), timeout=store_sync_timeout(next_store_sync))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            now = time.monotonic()
+            due_jobs = [job for job in pending_jobs if job.next_poll_at <= now]
+            
+            # Fetch all due jobs in one batched call
+            status_responses = await fetch_job_statuses(due_jobs)
             
-            for job in pending_jobs:
+            for job, status_response in zip(due_jobs, status_responses):
                 try:
-                    status_response = runpod_client.get_job_status(job.runpod_job_id)
+                    previous_status = job.status
                     
                     if "error" in status_response:
                         job.status = JobStatus.FAILED
                         job.error = status_response["error"]
-                        job.completed_at = datetime.now()
+                        job.mark_completed()
+                        await save_job(job)
+                        schedule_input_cleanup(job.job_id)
                         continue
                     
-                    runpod_status = status_response.get("status")
-                    
                     # Map RunPod status to our status
-                    if runpod_status == "IN_QUEUE":
-                        job.status = JobStatus.IN_QUEUE
-                    elif runpod_status == "IN_PROGRESS":
-                        job.status = JobStatus.IN_PROGRESS
-                    elif runpod_status == "COMPLETED":
-                        job.status = JobStatus.COMPLETED
-                        job.completed_at = datetime.now()
+                    new_status = RUNPOD_STATUS_MAP.get(status_response.get("status"))
+                    if new_status:
+                        job.status = new_status
+                        if new_status in FINISHED_STATUSES:
+                            job.mark_completed()
+                    
+                    if new_status == JobStatus.COMPLETED:
                         job.result = status_response.get("output", {})
+                        if job.result:
+                            stems = job.result.get("stems") or job.result.get("stem_urls") or {}
+                            job.stems_available = list(stems.keys())
                         
                         # Check if RunPod already uploaded to Supabase
                         if job.result and "stem_urls" in job.result:
@@ -121,49 +454,47 @@ async def sync_runpod_jobs():
                             job.supabase_urls = job.result["stem_urls"]
                             logger.info(f"RunPod handler uploaded {len(job.supabase_urls)} stems to Supabase for job {job.job_id}")
                         
-                        # Legacy: Upload to Supabase if we have base64 stems (fallback mode)
-                        elif (SUPABASE_AVAILABLE and supabase_storage and 
-                              job.result and "stems" in job.result and job.result["stems"] and
-                              job.result.get("storage_type") == "base64"):
-                            try:
-                                logger.info(f"Uploading base64 stems to Supabase for job {job.job_id}")
-                                
-                                # Convert base64 stems to files and upload
-                                import base64
-                                import io
-                                stem_files = {}
-                                
-                                for stem_name, stem_b64 in job.result["stems"].items():
-                                    # Decode base64 to bytes
-                                    stem_bytes = base64.b64decode(stem_b64)
-                                    stem_files[stem_name] = io.BytesIO(stem_bytes)
-                                
-                                # Upload to Supabase and get URLs
-                                urls = supabase_storage.upload_stems_from_bytes(job.job_id, stem_files)
-                                job.supabase_urls = urls
-                                
-                                logger.info(f"Successfully uploaded {len(urls)} stems to Supabase for job {job.job_id}")
-                                
-                            except Exception as e:
-                                logger.error(f"Failed to upload stems to Supabase for job {job.job_id}: {e}")
-                                # Don't fail the job, just log the error
-                    elif runpod_status == "FAILED":
-                        job.status = JobStatus.FAILED
+                        elif job.result and job.result.get("stems"):
+                            # Keep base64 results on disk instead of pinning them in memory
+                            await asyncio.to_thread(spill_stems, job)
+                            
+                            # Legacy: Upload to Supabase (fallback mode, off by default)
+                            if (LEGACY_BASE64_UPLOAD and SUPABASE_AVAILABLE and supabase_storage and
+                                    job.result.get("storage_type") == "base64" and job.upload_task is None):
+                                # Upload in the background so status sync for other jobs keeps going
+                                job.upload_task = asyncio.create_task(upload_completed_stems(job))
+                    elif new_status == JobStatus.FAILED:
                         job.error = status_response.get("error", "Unknown error")
-                        job.completed_at = datetime.now()
+                    
+                    # Back off polling for jobs that stay in the same state
+                    if job.status == previous_status:
+                        job.stable_ticks += 1
+                    else:
+                        job.stable_ticks = 0
+                        job.cached_response = None
+                        await save_job(job)
+                        if job.status in FINISHED_STATUSES:
+                            schedule_input_cleanup(job.job_id)
                     
                 except Exception as e:
                     logger.error(f"Error checking status for job {job.job_id}: {e}")
+                finally:
+                    job.next_poll_at = time.monotonic() + job_poll_interval(job)
             
-            await asyncio.sleep(5)  # Check every 5 seconds
+            # Sleep until the next job is due or the store is scanned, waking early if a new job is submitted
+            next_deadline = min(job.next_poll_at for job in pending_jobs)
+            job_wakeup.clear()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=store_sync_timeout(next_store_sync, next_deadline))
+            except asyncio.TimeoutError:
+                pass
             
         except Exception as e:
             logger.error(f"Error in RunPod sync: {e}")
             await asyncio.sleep(10)
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize RunPod client and background tasks"""
+def init_services():
+    """Create the RunPod client and Supabase storage from the environment"""
     global runpod_client, supabase_storage
     
     try:
@@ -172,9 +503,6 @@ async def startup_event():
             runpod_client = create_runpod_client()
             if runpod_client:
                 logger.info("RunPod client initialized successfully")
-                # Start background job status sync
-                asyncio.create_task(sync_runpod_jobs())
-                logger.info("Background RunPod sync started")
             else:
                 logger.warning("RunPod credentials not found - separation will not work")
         else:
@@ -191,7 +519,7 @@ async def startup_event():
                 logger.info(f"Supabase URL: {supabase_url[:30] + '...' if supabase_url else 'Not set'}")
                 logger.info(f"Supabase Anon Key: {'Set' if supabase_anon_key else 'Not set'}")
                 
-                supabase_storage = SupabaseStemStorage()
+                supabase_storage = get_storage()
                 logger.info("Supabase storage initialized successfully")
             except Exception as e:
                 logger.warning(f"Failed to initialize Supabase storage: {e}")
@@ -206,6 +534,32 @@ async def startup_event():
         runpod_client = None
         supabase_storage = None
 
+@app.on_event("startup")
+async def startup_event():
+    """Initialize RunPod client and background tasks"""
+    global is_poller
+    
+    init_services()
+    
+    if not runpod_client:
+        return
+    
+    if RUNPOD_SYNC_MODE == "external":
+        logger.info("RunPod sync runs in a separate worker process (runpod_sync.py) - serving job state from the job store")
+    # Start background job status sync in exactly one worker
+    elif acquire_poller_lock():
+        is_poller = True
+        asyncio.create_task(sync_runpod_jobs())
+        logger.info("Background RunPod sync started")
+    else:
+        logger.info("Another worker is syncing RunPod jobs - serving job state from the job store")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled HTTP connections"""
+    if runpod_client:
+        await runpod_client.aclose()
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -246,6 +600,10 @@ async def separate_audio(
         if not file.content_type.startswith("audio/"):
             raise HTTPException(status_code=400, detail="File must be an audio file")
         
+        # Sniff the container signature instead of trusting the client's content type
+        if not is_audio_header(await file.read(AUDIO_SNIFF_BYTES)):
+            raise HTTPException(status_code=400, detail="File is not a recognised audio format")
+        
         # Parse stems parameter
         stem_list = ["vocals", "bass", "drums", "other"]  # default
         if stems:
@@ -254,29 +612,29 @@ async def separate_audio(
         # Generate job ID
         job_id = str(uuid.uuid4())
         
-        # Read file content
-        content = await file.read()
-        
         logger.info(f"Submitting job {job_id} to RunPod for stems: {stem_list}")
         
-        # Save file temporarily for RunPod submission
-        file_path = UPLOAD_DIR / f"{job_id}_{file.filename}"
-        with open(file_path, "wb") as buffer:
-            buffer.write(content)
-        
-        # Submit to RunPod
+        # Submit to RunPod straight from the uploaded file object (no temp file copy)
+        audio_url = runpod_job_id = None
         try:
-            runpod_job_id = runpod_client.separate_stems_async(str(file_path), stem_list)
+            await file.seek(0)
+            if supabase_storage:
+                # Hand RunPod an expiring storage URL instead of inlining the audio as base64
+                audio_url = await asyncio.to_thread(
+                    supabase_storage.upload_input, job_id, file.file, file.content_type
+                )
+                runpod_job_id = await runpod_client.separate_stems_from_url(audio_url, stem_list, job_id)
+            else:
+                runpod_job_id = await runpod_client.separate_stems_async(file.file, stem_list, job_id)
             
             # Create job tracking
             job = RunPodJob(job_id, runpod_job_id, stem_list)
             active_jobs[job_id] = job
+            await save_job(job)
+            job_wakeup.set()
             
             logger.info(f"Job {job_id} submitted to RunPod as {runpod_job_id}")
             
-            # Clean up local file after submission
-            os.remove(file_path)
-            
             return {
                 "job_id": job_id,
                 "status": "submitted",
@@ -285,9 +643,9 @@ async def separate_audio(
             }
             
         except Exception as e:
-            # Clean up file on error
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # No job record exists to clean up after, so drop an input RunPod never received
+            if audio_url and runpod_job_id is None:
+                schedule_input_cleanup(job_id)
             raise HTTPException(status_code=500, detail=f"Failed to submit to RunPod: {str(e)}")
         
     except HTTPException:
@@ -301,84 +659,68 @@ async def download_stem(job_id: str, stem: str):
     """
     Download a specific stem from a completed RunPod job
     """
-    if job_id not in active_jobs:
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = active_jobs[job_id]
-    
     if job.status != JobStatus.COMPLETED:
         raise HTTPException(status_code=400, detail="Job not completed yet")
     
-    if not job.result or "stems" not in job.result:
+    # Stems stored in Supabase are served from there, no bytes pass through this process
+    if job.supabase_urls and stem in job.supabase_urls:
+        return RedirectResponse(job.supabase_urls[stem], status_code=307)
+    
+    if not job.stems_available:
         raise HTTPException(status_code=404, detail="No stems available for this job")
     
-    if stem not in job.result["stems"]:
-        available_stems = list(job.result["stems"].keys())
+    if stem not in job.stems_available:
         raise HTTPException(
             status_code=404, 
-            detail=f"Stem '{stem}' not found. Available stems: {available_stems}"
+            detail=f"Stem '{stem}' not found. Available stems: {job.stems_available}"
         )
     
-    # Decode base64 stem data
-    import base64
-    import io
-    from fastapi.responses import StreamingResponse
+    # Base64 results were decoded to disk on completion
+    stem_path = stem_file_path(job_id, stem)
+    if not stem_path.exists():
+        logger.error(f"Stem file missing for stem {stem} of job {job_id}: {stem_path}")
+        raise HTTPException(status_code=404, detail="Stem file no longer available")
     
-    try:
-        stem_b64 = job.result["stems"][stem]
-        stem_bytes = base64.b64decode(stem_b64)
-        
-        # Return as streaming response
-        return StreamingResponse(
-            io.BytesIO(stem_bytes),
-            media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename={stem}.wav"}
-        )
-    except Exception as e:
-        logger.error(f"Error downloading stem {stem} for job {job_id}: {e}")
-        raise HTTPException(status_code=500, detail="Error processing stem file")
+    return FileResponse(stem_path, media_type="audio/wav", filename=f"{stem}.wav")
 
 @app.get("/jobs/{job_id}")
-async def get_job_status(job_id: str):
+async def get_job_status(job_id: str, request: Request):
     """
     Get the status and results for a RunPod job
     """
-    if job_id not in active_jobs:
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = active_jobs[job_id]
+    # Let polling clients skip the body when nothing changed, and let browsers/CDNs absorb bursts
+    etag = job_etag(job)
+    headers = {"ETag": etag, "Cache-Control": f"max-age={JOB_RESPONSE_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    # Reuse the serialized response; it is cleared whenever the job changes
+    if job.cached_response is not None and job.cached_state == job.status:
+        return Response(content=job.cached_response, media_type="application/json", headers=headers)
     
     response = {
         "job_id": job_id,
-        "status": job.status.value,
-        "created_at": job.created_at.isoformat(),
-        "completed_at": job.completed_at.isoformat() if job.completed_at else None,
+        "status": job.status,
+        "created_at": job.created_at_iso,
+        "completed_at": job.completed_at_iso,
         "runpod_job_id": job.runpod_job_id,
-        "stems": job.stems
+        "stems": job.stems,
+        **STATUS_RESPONSE_FIELDS.get(job.status, {})
     }
     
-    if job.status == JobStatus.SUBMITTED:
-        response.update({
-            "message": "Job submitted to RunPod, waiting for processing to start"
-        })
-    elif job.status == JobStatus.IN_QUEUE:
-        response.update({
-            "message": "Job is queued in RunPod, waiting for available GPU"
-        })
-    elif job.status == JobStatus.IN_PROGRESS:
-        response.update({
-            "message": "Job is currently being processed on RunPod GPU"
-        })
-    elif job.status == JobStatus.COMPLETED:
+    if job.status == JobStatus.COMPLETED:
         if job.result:
-            # Convert base64 stems to download URLs
-            stems_available = []
-            if "stems" in job.result:
-                stems_available = list(job.result["stems"].keys())
-            
             response.update({
                 "message": "Job completed successfully",
-                "stems_available": stems_available,
+                "stems_available": job.stems_available,
                 "download_info": "Use /download/{job_id}/{stem} to download individual stems"
             })
             
@@ -391,41 +733,61 @@ async def get_job_status(job_id: str):
         else:
             response["message"] = "Job completed but no result available"
     elif job.status == JobStatus.FAILED:
-        response.update({
-            "message": "Job failed",
-            "error": job.error
-        })
+        response["error"] = job.error
     
-    return response
+    # orjson serializes the str Enum natively; no response object is needed just to render bytes
+    job.cached_response = orjson.dumps(response)
+    job.cached_state = job.status
+    return Response(content=job.cached_response, media_type="application/json", headers=headers)
 
 @app.delete("/jobs/{job_id}")
-async def delete_job(job_id: str):
+async def delete_job(job_id: str, background_tasks: BackgroundTasks):
     """
     Delete a job and its output files
     """
     job_dir = OUTPUT_DIR / job_id
     
-    if not job_dir.exists():
+    job = await get_job(job_id)
+    if job is None and not job_dir.exists():
         raise HTTPException(status_code=404, detail="Job not found")
     
-    # Remove all files in the job directory
-    for file in job_dir.glob("*"):
-        file.unlink()
-    
-    # Remove the directory
-    job_dir.rmdir()
-    
-    # Clean up Supabase storage
-    if supabase_storage:
+    def delete_supabase_stems():
+        # Clean up Supabase storage; the URLs of uploaded stems name their objects, skipping the listing
         try:
-            supabase_storage.delete_stems(job_id)
+            supabase_storage.delete_stems(job_id, job.supabase_urls if job else None)
             logger.info(f"Deleted Supabase stems for job {job_id}")
         except Exception as e:
             logger.warning(f"Failed to delete Supabase stems: {e}")
+        # The source audio is already gone for finished jobs; this covers ones deleted mid-flight
+        try:
+            supabase_storage.delete_input(job_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete input audio: {e}")
+    
+    # Drop job tracking; the job is gone as soon as this returns
+    active_jobs.pop(job_id, None)
+    await asyncio.to_thread(job_store.delete, job_id)
+    
+    # Remove local output files and remote stems after the response is sent
+    background_tasks.add_task(shutil.rmtree, job_dir, ignore_errors=True)
+    if supabase_storage:
+        background_tasks.add_task(delete_supabase_stems)
     
     return {"message": f"Job {job_id} deleted successfully"}
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Workers share job state through the job store and elect a single RunPod poller; only the
+    # poller holds live job state in memory, so more than one worker is opt-in
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    # uvloop + httptools ship with uvicorn[standard]; override with "auto"/"asyncio"/"h11" if unavailable
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        backlog=int(os.environ.get("UVICORN_BACKLOG", 2048)),
+        loop=os.environ.get("UVICORN_LOOP", "uvloop"),
+        http=os.environ.get("UVICORN_HTTP", "httptools")
+    )
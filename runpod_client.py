@@ -1,51 +1,173 @@
 """
 RunPod API Client for stem separation
 """
-import requests
-import base64
+import httpx
+import asyncio
+import io
 import time
+import zlib
 import logging
 import os
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union, BinaryIO, Tuple, AsyncIterator
 
 logger = logging.getLogger(__name__)
 
+# Status responses can carry large base64 results, so parse them with orjson when available
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    import json
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Inline audio is multi-MB base64, so use pybase64's SIMD codec when available
+try:
+    from pybase64 import b64encode, b64decode
+except ImportError:
+    from base64 import b64encode, b64decode
+
+# Read size for incremental base64; a multiple of 3 so chunk encodings concatenate cleanly
+B64_READ_CHUNK = 3 * 1024 * 1024
+
 class RunPodClient:
-    def __init__(self, api_key: str, endpoint_id: str):
+    def __init__(self, api_key: str, endpoint_id: str, compress_payloads: bool = False):
         """
         Initialize RunPod client
         
         Args:
             api_key: RunPod API key
             endpoint_id: RunPod serverless endpoint ID
+            compress_payloads: gzip inline-audio request bodies (trades CPU for bandwidth)
         """
         self.api_key = api_key
         self.endpoint_id = endpoint_id
+        self.compress_payloads = compress_payloads
         self.base_url = f"https://api.runpod.ai/v2/{endpoint_id}"
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        # Shared async client so submits and polls reuse pooled HTTP/2 connections
+        self.client = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            timeout=httpx.Timeout(60.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)
+        )
+    
+    async def aclose(self):
+        """Close the underlying HTTP client"""
+        await self.client.aclose()
+    
+    def encode_audio_stream(self, stream: BinaryIO) -> str:
+        """Encode a buffered binary stream to base64 chunk by chunk, never holding the raw file"""
+        encoded = bytearray()
+        # Buffered reads return the full chunk size until EOF, keeping chunks 3-byte aligned
+        while chunk := stream.read(B64_READ_CHUNK):
+            encoded += b64encode(chunk)
+        return encoded.decode('ascii')
     
     def encode_audio_file(self, file_path: str) -> str:
         """Encode audio file to base64"""
         with open(file_path, 'rb') as f:
-            return base64.b64encode(f.read()).decode('utf-8')
+            return self.encode_audio_stream(f)
     
     def encode_audio_bytes(self, audio_bytes: bytes) -> str:
         """Encode audio bytes to base64"""
-        return base64.b64encode(audio_bytes).decode('utf-8')
+        return b64encode(audio_bytes).decode('utf-8')
+    
+    def encode_audio(self, audio: Union[str, bytes, BinaryIO]) -> str:
+        """Encode a file path, raw bytes or binary file object to base64"""
+        if isinstance(audio, (bytes, bytearray)):
+            return self.encode_audio_bytes(audio)
+        if isinstance(audio, str):
+            return self.encode_audio_file(audio)
+        return self.encode_audio_stream(audio)
+    
+    def stream_payload(self, audio: Union[str, bytes, BinaryIO], stems: List[str],
+                       job_id: Optional[str] = None) -> Tuple[int, AsyncIterator[bytes]]:
+        """
+        Build the RunPod input JSON as a stream, base64-encoding the audio on the fly
+        
+        Args:
+            audio: Path to audio file, raw audio bytes or seekable binary file object
+            stems: List of stems to separate
+            job_id: API job ID the worker stores the stems under
+        
+        Returns:
+            (content_length, body) where body yields the JSON payload in chunks
+        """
+        if isinstance(audio, (bytes, bytearray)):
+            stream, owned = io.BytesIO(audio), True
+        elif isinstance(audio, str):
+            stream, owned = open(audio, 'rb'), True
+        else:
+            stream, owned = audio, False
+        
+        start = stream.tell()
+        audio_size = stream.seek(0, io.SEEK_END) - start
+        stream.seek(start)
+        
+        stems_json = json_dumps(stems)
+        if isinstance(stems_json, str):
+            stems_json = stems_json.encode('utf-8')
+        prefix = b'{"input": {"stems": ' + stems_json + b', '
+        if job_id:
+            job_id_json = json_dumps(job_id)
+            if isinstance(job_id_json, str):
+                job_id_json = job_id_json.encode('utf-8')
+            prefix += b'"job_id": ' + job_id_json + b', '
+        prefix += b'"audio_file": "'
+        suffix = b'"}}'
+        content_length = len(prefix) + 4 * ((audio_size + 2) // 3) + len(suffix)
+        
+        async def body() -> AsyncIterator[bytes]:
+            try:
+                yield prefix
+                while chunk := await asyncio.to_thread(stream.read, B64_READ_CHUNK):
+                    yield b64encode(chunk)
+                yield suffix
+            finally:
+                if owned:
+                    stream.close()
+        
+        return content_length, body()
+    
+    def request_body(self, audio: Union[str, bytes, BinaryIO], stems: List[str],
+                     job_id: Optional[str] = None) -> Tuple[Dict[str, str], AsyncIterator[bytes]]:
+        """
+        Build the streamed request body and its headers, gzip-compressed when enabled
+        
+        Returns:
+            (headers, body) for the POST request
+        """
+        content_length, body = self.stream_payload(audio, stems, job_id)
+        if not self.compress_payloads:
+            return {"Content-Length": str(content_length)}, body
+        
+        async def gzipped() -> AsyncIterator[bytes]:
+            # wbits=31 produces a gzip container; the compressed length is unknown, so the body is chunked
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            async for chunk in body:
+                # zlib releases the GIL, so compress off the event loop
+                if data := await asyncio.to_thread(compressor.compress, chunk):
+                    yield data
+            yield compressor.flush()
+        
+        return {"Content-Encoding": "gzip"}, gzipped()
     
     def decode_stem(self, stem_b64: str) -> bytes:
         """Decode base64 stem back to audio bytes"""
-        return base64.b64decode(stem_b64)
+        return b64decode(stem_b64)
     
-    def separate_stems_sync(self, audio_file_path: str, stems: List[str], timeout: int = 300) -> Dict:
+    async def separate_stems_sync(self, audio: Union[str, bytes, BinaryIO], stems: List[str], timeout: int = 300) -> Dict:
         """
-        Synchronous stem separation (blocks until complete)
+        Synchronous stem separation (waits until RunPod completes the job)
         
         Args:
-            audio_file_path: Path to audio file
+            audio: Path to audio file, raw audio bytes or binary file object
             stems: List of stems to separate
             timeout: Maximum wait time in seconds
         
@@ -53,76 +175,107 @@ class RunPodClient:
             Dict containing separated stems as base64 or error
         """
         try:
-            # Encode audio file
-            audio_b64 = self.encode_audio_file(audio_file_path)
-            
-            # Prepare request
-            payload = {
-                "input": {
-                    "audio_file": audio_b64,
-                    "stems": stems
-                }
-            }
+            # Stream the request body, encoding the audio chunk by chunk
+            headers, body = self.request_body(audio, stems)
             
             logger.info(f"Sending synchronous request to RunPod for stems: {stems}")
             
             # Send synchronous request
-            response = requests.post(
+            response = await self.client.post(
                 f"{self.base_url}/runsync",
-                headers=self.headers,
-                json=payload,
+                content=body,
+                headers=headers,
                 timeout=timeout
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = json_loads(response.content)
                 logger.info("RunPod separation completed successfully")
                 return result
             else:
                 logger.error(f"RunPod request failed: {response.status_code} - {response.text}")
                 return {"error": f"RunPod API error: {response.status_code}"}
         
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error("RunPod request timed out")
             return {"error": "Request timed out"}
         except Exception as e:
             logger.error(f"RunPod client error: {e}")
             return {"error": str(e)}
     
-    def separate_stems_async(self, audio_file_path: str, stems: List[str]) -> str:
+    async def separate_stems_async(self, audio: Union[str, bytes, BinaryIO], stems: List[str],
+                                   job_id: Optional[str] = None) -> str:
         """
         Asynchronous stem separation (returns job ID immediately)
         
         Args:
-            audio_file_path: Path to audio file
+            audio: Path to audio file, raw audio bytes or binary file object
             stems: List of stems to separate
+            job_id: API job ID the worker stores the stems under (it picks its own when omitted)
         
         Returns:
             Job ID for polling status
         """
         try:
-            # Encode audio file
-            audio_b64 = self.encode_audio_file(audio_file_path)
+            # Stream the request body, encoding the audio chunk by chunk
+            headers, body = self.request_body(audio, stems, job_id)
+            
+            logger.info(f"Sending async request to RunPod for stems: {stems}")
+            
+            # Send async request
+            response = await self.client.post(
+                f"{self.base_url}/run",
+                content=body,
+                headers=headers
+            )
             
-            # Prepare request
+            if response.status_code == 200:
+                result = json_loads(response.content)
+                job_id = result.get("id")
+                logger.info(f"RunPod job submitted: {job_id}")
+                return job_id
+            else:
+                logger.error(f"RunPod request failed: {response.status_code} - {response.text}")
+                raise Exception(f"RunPod API error: {response.status_code}")
+        
+        except Exception as e:
+            logger.error(f"RunPod client error: {e}")
+            raise e
+    
+    async def separate_stems_from_url(self, audio_url: str, stems: List[str],
+                                      job_id: Optional[str] = None) -> str:
+        """
+        Asynchronous stem separation of audio the worker downloads itself
+        
+        Sends only a URL instead of inlining the audio as base64.
+        
+        Args:
+            audio_url: URL the RunPod worker can fetch the audio from
+            stems: List of stems to separate
+            job_id: API job ID the worker stores the stems under (it picks its own when omitted)
+        
+        Returns:
+            Job ID for polling status
+        """
+        try:
             payload = {
                 "input": {
-                    "audio_file": audio_b64,
+                    "audio_url": audio_url,
                     "stems": stems
                 }
             }
+            if job_id:
+                payload["input"]["job_id"] = job_id
             
-            logger.info(f"Sending async request to RunPod for stems: {stems}")
+            logger.info(f"Sending async URL request to RunPod for stems: {stems}")
             
-            # Send async request
-            response = requests.post(
+            response = await self.client.post(
                 f"{self.base_url}/run",
-                headers=self.headers,
-                json=payload
+                content=json_dumps(payload)
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = json_loads(response.content)
                 job_id = result.get("id")
                 logger.info(f"RunPod job submitted: {job_id}")
                 return job_id
@@ -134,7 +287,7 @@ class RunPodClient:
             logger.error(f"RunPod client error: {e}")
             raise e
     
-    def get_job_status(self, job_id: str) -> Dict:
+    async def get_job_status(self, job_id: str) -> Dict:
         """
         Get status of async job
         
@@ -145,13 +298,10 @@ class RunPodClient:
             Job status and results
         """
         try:
-            response = requests.get(
-                f"{self.base_url}/status/{job_id}",
-                headers=self.headers
-            )
+            response = await self.client.get(f"{self.base_url}/status/{job_id}")
             
             if response.status_code == 200:
-                return response.json()
+                return json_loads(response.content)
             else:
                 logger.error(f"Status check failed: {response.status_code} - {response.text}")
                 return {"error": f"Status API error: {response.status_code}"}
@@ -160,7 +310,37 @@ class RunPodClient:
             logger.error(f"Status check error: {e}")
             return {"error": str(e)}
     
-    def wait_for_completion(self, job_id: str, polling_interval: int = 5, max_wait: int = 300) -> Dict:
+    async def get_job_statuses(self, job_ids: List[str], max_concurrency: int = 16) -> Dict[str, Dict]:
+        """
+        Get status of several async jobs in one call
+        
+        RunPod has no bulk status endpoint, so the per-job requests are
+        issued concurrently over the shared connection pool.
+        
+        Args:
+            job_ids: Job IDs returned from async requests
+            max_concurrency: Maximum status requests in flight at once
+        
+        Returns:
+            Dict of job_id -> job status and results
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def bounded_status(job_id: str) -> Dict:
+            async with semaphore:
+                return await self.get_job_status(job_id)
+        
+        statuses = await asyncio.gather(
+            *[bounded_status(job_id) for job_id in job_ids],
+            return_exceptions=True
+        )
+        # One failed request must not poison the batch
+        return {
+            job_id: {"error": str(status)} if isinstance(status, BaseException) else status
+            for job_id, status in zip(job_ids, statuses)
+        }
+    
+    async def wait_for_completion(self, job_id: str, polling_interval: int = 5, max_wait: int = 300) -> Dict:
         """
         Poll job status until completion
         
@@ -172,10 +352,10 @@ class RunPodClient:
         Returns:
             Final job result
         """
-        start_time = time.time()
+        start_time = time.monotonic()
         
-        while time.time() - start_time < max_wait:
-            status = self.get_job_status(job_id)
+        while time.monotonic() - start_time < max_wait:
+            status = await self.get_job_status(job_id)
             
             if "error" in status:
                 return status
@@ -191,10 +371,10 @@ class RunPodClient:
                 return {"error": f"Job failed: {error_msg}"}
             elif job_status in ["IN_QUEUE", "IN_PROGRESS"]:
                 logger.info(f"Job {job_id} status: {job_status}")
-                time.sleep(polling_interval)
+                await asyncio.sleep(polling_interval)
             else:
                 logger.warning(f"Unknown job status: {job_status}")
-                time.sleep(polling_interval)
+                await asyncio.sleep(polling_interval)
         
         logger.error(f"Job {job_id} timed out after {max_wait} seconds")
         return {"error": "Job timed out"}
@@ -208,4 +388,5 @@ def create_runpod_client() -> Optional[RunPodClient]:
         logger.warning("RunPod credentials not found in environment")
         return None
     
-    return RunPodClient(api_key, endpoint_id)
+    compress_payloads = os.environ.get("RUNPOD_GZIP_PAYLOADS", "false").lower() == "true"
+    return RunPodClient(api_key, endpoint_id, compress_payloads=compress_payloads)
@@ -3,26 +3,47 @@ RunPod Serverless Handler for Stem Separation
 This file will be deployed to RunPod's serverless GPU infrastructure
 
 """
+import os
+# Let the caching allocator grow segments in place instead of fragmenting; read on first CUDA use
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import runpod
 import torch
 import torchaudio
-import demucs.separate
+from demucs.pretrained import get_model
+from demucs.apply import BagOfModels, apply_model
+from demucs.htdemucs import HTDemucs
+from demucs.utils import center_trim
 import soundfile as sf
-import numpy as np
 import tempfile
-import glob
-import shutil
-import sys
-import os
-import base64
+import binascii
+import contextlib
+import functools
+import random
 import io
+import threading
+import time
+import traceback
+import uuid
+import asyncio
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Union
+from urllib.parse import urlparse
 import logging
 # Import Supabase client for RunPod
 from supabase_client import SupabaseClient
 
+# FFmpeg-backed decoder that reads paths and in-memory files alike (needs the FFmpeg libraries)
+try:
+    from torchaudio.io import StreamReader
+except ImportError:
+    StreamReader = None
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+# Per-request detail is logged at DEBUG; set STEMI_LOGLEVEL=DEBUG to see it
+logging.basicConfig(level=os.getenv("STEMI_LOGLEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 def initialize():
@@ -30,169 +51,688 @@ def initialize():
     if torch.cuda.is_available():
         device = torch.device("cuda")
         logger.info(f"Using GPU: {torch.cuda.get_device_name(0)}")
-        # Clear GPU memory
-        torch.cuda.empty_cache()
     else:
         device = torch.device("cpu")
         logger.info("Using CPU")
     
     return device
 
-def separate_stems(audio_data: bytes, stems: list, device) -> dict:
+# Demucs model used when a job doesn't pick one; it is loaded and warmed up at start
+DEMUCS_MODEL_NAME = 'htdemucs_6s'
+# Models a job may pick with input["model"] (comma-separated); the default stays resident,
+# the others are loaded on first use and share one more slot
+DEMUCS_MODELS = frozenset({DEMUCS_MODEL_NAME, *(name.strip() for name in os.getenv("DEMUCS_MODELS", "htdemucs").split(","))}) - {""}
+# Stems the service exposes, and the ones separated when a job doesn't ask for specific stems
+VALID_STEMS = frozenset({'vocals', 'bass', 'drums', 'other', 'guitar', 'piano'})
+DEFAULT_STEMS = ('vocals', 'bass', 'drums', 'other')
+
+# torch.compile mode for the Demucs forward pass (e.g. "reduce-overhead", "max-autotune"); unset disables it
+DEMUCS_COMPILE_MODE = os.getenv("DEMUCS_COMPILE_MODE")
+# Capture the fixed-shape Demucs segment forward as CUDA graphs and replay them (ignored when compiling);
+# shapes are captured during warm-up only, later shapes and failed captures run eagerly
+DEMUCS_CUDA_GRAPHS = os.getenv("DEMUCS_CUDA_GRAPHS", "true").lower() == "true"
+
+class CUDAGraphForward:
+    """Replays a captured CUDA graph of a model forward, one graph per input shape"""
+    
+    def __init__(self, forward):
+        self.forward = forward
+        self.graphs = {}  # (shape, dtype) -> (graph, static_input, static_output), or None if capture failed
+        self.lock = threading.Lock()
+        # Set by warm_up; capturing while jobs run would race their CUDA work
+        self.capturing = False
+    
+    def capture(self, mix: torch.Tensor):
+        static_input = mix.clone()
+        
+        # Warm up on a side stream so lazy initialisation (cuDNN plans, allocations) is not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                self.forward(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+        
+        graph = torch.cuda.CUDAGraph()
+        # thread_local: CUDA calls from other threads (stem copies, uploads) can't invalidate the capture
+        with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+            static_output = self.forward(static_input)
+        return graph, static_input, static_output
+    
+    def __call__(self, mix: torch.Tensor) -> torch.Tensor:
+        if mix.device.type != 'cuda':
+            return self.forward(mix)
+        
+        key = (tuple(mix.shape), mix.dtype)
+        with self.lock:
+            if key not in self.graphs and self.capturing:
+                try:
+                    self.graphs[key] = self.capture(mix)
+                    logger.info(f"Captured CUDA graph for Demucs segment shape {key[0]}")
+                except Exception as e:
+                    logger.warning(f"CUDA graph capture failed for shape {key[0]}, running eagerly: {e}")
+                    self.graphs[key] = None
+            
+            captured = self.graphs.get(key)
+            if captured is None:
+                return self.forward(mix)
+            
+            graph, static_input, static_output = captured
+            static_input.copy_(mix)
+            graph.replay()
+            # The static output is overwritten by the next replay
+            return static_output.clone()
+
+def sub_models(model) -> list:
+    """The individual models of a bag, or the model itself"""
+    return model.models if isinstance(model, BagOfModels) else [model]
+
+def load_model(device, name: str = DEMUCS_MODEL_NAME):
+    """Load a Demucs model onto the device once for the lifetime of the worker"""
+    logger.info(f"Loading Demucs model {name}...")
+    model = get_model(name)
+    model.to(device)
+    model.eval()
+    
+    # apply_model reads segment/samplerate off the sub-models, so only their forward is wrapped
+    if DEMUCS_COMPILE_MODE and device.type == 'cuda':
+        for sub_model in sub_models(model):
+            sub_model.forward = torch.compile(sub_model.forward, mode=DEMUCS_COMPILE_MODE, fullgraph=False)
+        logger.info(f"Demucs forward compiled with mode {DEMUCS_COMPILE_MODE} (first job pays the compile)")
+    elif DEMUCS_CUDA_GRAPHS and device.type == 'cuda':
+        # Segments are padded to the model's training length, so every forward of a batch size sees the same shape
+        for sub_model in sub_models(model):
+            sub_model.forward = CUDAGraphForward(sub_model.forward)
+        logger.info("Demucs forward will be replayed from CUDA graphs captured at warm-up")
+    
+    logger.info("Demucs model loaded")
+    return model
+
+_model_lock = threading.Lock()
+_default_model = None
+
+@functools.lru_cache(maxsize=1)
+def _cached_model(name: str):
+    # Non-default models only: picking another one replaces it, never the default
+    return load_model(DEVICE, name)
+
+def get_loaded_model(name: str):
+    """Return a resident Demucs model, loading it on first use (the lock keeps concurrent jobs from loading it twice)"""
+    global _default_model
+    with _model_lock:
+        if name != DEMUCS_MODEL_NAME:
+            return _cached_model(name)
+        # Pinned outside the LRU, so MODEL and BATCHER.model stay the one resident copy
+        if _default_model is None:
+            _default_model = load_model(DEVICE, name)
+        return _default_model
+
+# Stems are downsampled to this rate before upload to save memory and bandwidth
+STEM_SAMPLE_RATE = 22050
+
+# Stem encodings: format -> (soundfile format, subtype, file extension, content type)
+STEM_FORMATS = {
+    "FLAC": ("FLAC", "PCM_16", "flac", "audio/flac"),
+    "WAV": ("WAV", "PCM_16", "wav", "audio/wav"),
+    # Lossy but a fraction of FLAC's size; needs libsndfile >= 1.1 (bundled with soundfile >= 0.12 wheels)
+    "MP3": ("MP3", "MPEG_LAYER_III", "mp3", "audio/mpeg"),
+}
+# Lossless FLAC is roughly half the size of WAV; set STEM_FORMAT=WAV for old clients or MP3 for previews
+STEM_FORMAT = os.getenv("STEM_FORMAT", "FLAC").upper()
+if STEM_FORMAT not in STEM_FORMATS:
+    raise ValueError(f"Unsupported STEM_FORMAT {STEM_FORMAT} - expected one of {list(STEM_FORMATS)}")
+
+@functools.lru_cache(maxsize=8)
+def get_resampler(orig_freq: int, new_freq: int, device):
+    """Build a resampling module once per rate pair and device; its filter kernel stays on the device"""
+    return torchaudio.transforms.Resample(orig_freq, new_freq).to(device)
+
+# Precision of Demucs convolutions/attention on GPU: auto, fp16, bf16 (Ampere+) or fp32
+DEMUCS_PRECISION = os.getenv("DEMUCS_PRECISION", "auto").lower()
+if DEMUCS_PRECISION == "auto":
+    # bf16 has fp32's range, so it can't overflow in the attention blocks the way fp16 can
+    DEMUCS_PRECISION = "bf16" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else "fp16"
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+def inference_context(device):
+    """Inference-mode context for Demucs, with mixed precision autocast on CUDA unless fp32 is requested"""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if device.type == 'cuda' and DEMUCS_PRECISION in AUTOCAST_DTYPES:
+        # autocast keeps precision-sensitive ops (STFT, norms, reductions) in fp32
+        # The autocast weight cache must be off for CUDA graph capture
+        stack.enter_context(torch.autocast('cuda', dtype=AUTOCAST_DTYPES[DEMUCS_PRECISION],
+                                           cache_enabled=not DEMUCS_CUDA_GRAPHS))
+    return stack
+
+_supabase_client = None
+
+def get_supabase_client() -> SupabaseClient:
+    """Return the worker's Supabase client, creating it on first use so its pooled connections outlive each job"""
+    global _supabase_client
+    if _supabase_client is None:
+        _supabase_client = SupabaseClient()
+        logger.info("Supabase client initialized successfully")
+    return _supabase_client
+
+# apply_model settings, the same as the demucs CLI defaults
+DEMUCS_SHIFTS = 1
+DEMUCS_OVERLAP = 0.25
+# Mixes longer than this are separated from host RAM so VRAM does not grow with track length
+DEMUCS_OFFLOAD_SECONDS = float(os.getenv("DEMUCS_OFFLOAD_SECONDS", 10 * 60))
+
+def demucs_forward(model, mix: torch.Tensor, device, offload: bool = False) -> torch.Tensor:
+    """
+    Run Demucs in-process on a batch of normalized mixes
+    
+    Args:
+        model: Demucs model already loaded on device
+        mix: (batch, channels, samples) tensor at the model sample rate
+        device: Torch device
+        offload: Separate from host memory regardless of the mix length
+    
+    Returns:
+        (batch, sources, channels, samples) tensor, in host memory for mixes
+        longer than DEMUCS_OFFLOAD_SECONDS or when offloading
+    """
+    if device.type == 'cuda' and (offload or mix.shape[-1] > DEMUCS_OFFLOAD_SECONDS * model.samplerate):
+        # Keep long mixes and their sources in host RAM; only one segment group is on the GPU at a time
+        mix = mix.cpu()
+    
+    with inference_context(device):
+        if DEMUCS_SEGMENT_BATCH > 1:
+            return apply_batched(model, mix, device)
+        return apply_model(
+            model, mix,
+            device=device, shifts=DEMUCS_SHIFTS, split=True, overlap=DEMUCS_OVERLAP, progress=False
+        )
+
+# Segments run through the model per forward call. 1 (the default) uses demucs' own
+# one-segment-at-a-time apply_model; larger values switch to apply_batched, a
+# reimplementation of it that nothing checks against new demucs releases, so opt in
+DEMUCS_SEGMENT_BATCH = int(os.getenv("DEMUCS_SEGMENT_BATCH", 1))
+
+def pad_segment(mix: torch.Tensor, offset: int, length: int, target_length: int) -> torch.Tensor:
+    """Widen mix[..., offset:offset + length] symmetrically to target_length, zero-padding past the edges (like TensorChunk.padded)"""
+    total_length = mix.shape[-1]
+    start = offset - (target_length - length) // 2
+    end = start + target_length
+    segment = mix[..., max(0, start):min(total_length, end)]
+    return torch.nn.functional.pad(segment, (max(0, start) - start, end - min(total_length, end)))
+
+def split_batched(model: HTDemucs, mix: torch.Tensor, device) -> torch.Tensor:
+    """
+    Overlap-add separation like apply_model(split=True), but running DEMUCS_SEGMENT_BATCH segments per forward
+    
+    The output stays on mix's device; segments are moved to device for each forward.
+    """
+    batch, channels, length = mix.shape
+    segment_length = int(model.samplerate * model.segment)
+    stride = int((1 - DEMUCS_OVERLAP) * segment_length)
+    offsets = list(range(0, length, stride))
+    
+    # Triangular cross-fade weights, as in apply_model
+    weight = torch.cat([
+        torch.arange(1, segment_length // 2 + 1, device=mix.device),
+        torch.arange(segment_length - segment_length // 2, 0, -1, device=mix.device),
+    ]).float()
+    weight = weight / weight.max()
+    
+    out = torch.zeros(batch, len(model.sources), channels, length, device=mix.device)
+    sum_weight = torch.zeros(length, device=mix.device)
+    for i in range(0, len(offsets), DEMUCS_SEGMENT_BATCH):
+        group = offsets[i:i + DEMUCS_SEGMENT_BATCH]
+        chunk_lengths = [min(segment_length, length - offset) for offset in group]
+        segments = [
+            pad_segment(mix, offset, chunk_length, model.valid_length(chunk_length))
+            for offset, chunk_length in zip(group, chunk_lengths)
+        ]
+        # Pad the last group to a full batch so every forward (and CUDA graph) has the same shape
+        segments += [torch.zeros_like(segments[0])] * (DEMUCS_SEGMENT_BATCH - len(segments))
+        
+        segment_batch = torch.cat(segments).to(device, non_blocking=True)
+        outputs = model(segment_batch).view(DEMUCS_SEGMENT_BATCH, batch, len(model.sources), channels, -1)
+        for output, offset, chunk_length in zip(outputs, group, chunk_lengths):
+            output = center_trim(output, chunk_length).to(out.device)
+            out[..., offset:offset + chunk_length] += weight[:chunk_length] * output
+            sum_weight[offset:offset + chunk_length] += weight[:chunk_length]
+    
+    return out / sum_weight
+
+def apply_batched(model, mix: torch.Tensor, device) -> torch.Tensor:
+    """apply_model with the same bag weighting and random shifts, built on split_batched"""
+    if isinstance(model, BagOfModels):
+        estimates = 0
+        totals = [0] * len(model.sources)
+        for sub_model, model_weights in zip(model.models, model.weights):
+            out = apply_batched(sub_model, mix, device)
+            for k, inst_weight in enumerate(model_weights):
+                out[:, k] *= inst_weight
+                totals[k] += inst_weight
+            estimates += out
+        for k in range(estimates.shape[1]):
+            estimates[:, k] /= totals[k]
+        return estimates
+    
+    # Only HTDemucs pads every segment to one training length; other models keep demucs' loop
+    if not isinstance(model, HTDemucs):
+        return apply_model(
+            model, mix,
+            device=device, shifts=DEMUCS_SHIFTS, split=True, overlap=DEMUCS_OVERLAP, progress=False
+        )
+    
+    # Random time shifts, averaged (the shift trick), as in apply_model
+    max_shift = int(0.5 * model.samplerate)
+    length = mix.shape[-1]
+    padded = torch.nn.functional.pad(mix, (max_shift, max_shift))
+    out = 0
+    for _ in range(DEMUCS_SHIFTS):
+        offset = random.randint(0, max_shift)
+        shifted = padded[..., offset:length + max_shift]
+        out += split_batched(model, shifted, device)[..., max_shift - offset:]
+    return out / DEMUCS_SHIFTS
+
+# Concurrent jobs per worker whose separations share one Demucs forward pass (1 disables batching)
+DEMUCS_MAX_BATCH = int(os.getenv("DEMUCS_MAX_BATCH", 1))
+# How long the first job of a batch waits for others to join
+DEMUCS_BATCH_WINDOW = float(os.getenv("DEMUCS_BATCH_WINDOW_MS", 50)) / 1000
+
+class DemucsBatcher:
+    """Collects separations from concurrent jobs and runs them through one padded batched forward pass"""
+    
+    def __init__(self, model, device, max_batch: int, window: float):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.window = window
+        self.pending = []
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def separate(self, waveform: torch.Tensor) -> torch.Tensor:
+        """
+        Separate one normalized waveform, blocking until its batch has run
+        
+        Args:
+            waveform: Normalized (channels, samples) mix
+        
+        Returns:
+            (sources, channels, samples) tensor
+        """
+        future = Future()
+        with self.condition:
+            self.pending.append((waveform, future))
+            self.condition.notify()
+        return future.result()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Give other jobs a short window to join the batch
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            
+            self._run_batch(batch)
+            del batch
+    
+    def _run_batch(self, batch: list):
+        # Kept out of _run so the batch tensors are released on return, not held until the next batch
+        try:
+            # Zero-pad to the longest mix and trim each output back to its own length
+            length = max(waveform.shape[-1] for waveform, _ in batch)
+            mix = torch.stack([
+                torch.nn.functional.pad(waveform, (0, length - waveform.shape[-1]))
+                for waveform, _ in batch
+            ])
+            logger.info(f"Running batched Demucs separation for {len(batch)} jobs")
+            sources = demucs_forward(self.model, mix, self.device)
+            for (waveform, future), job_sources in zip(batch, sources):
+                future.set_result(job_sources[..., :waveform.shape[-1]])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+def rescale_to_unit(wav: torch.Tensor) -> torch.Tensor:
+    """
+    Scale a stem down if it would clip, like demucs.audio.prevent_clip(mode='rescale')
+    
+    prevent_clip compares the peak with a Python max(), which waits for the GPU;
+    keeping the comparison on the device lets the stem pipeline run without a sync.
+    """
+    return wav / torch.clamp(1.01 * wav.abs().amax(), min=1)
+
+def copy_to_host(tensor: torch.Tensor, stream=None):
+    """
+    Start copying a device tensor into pinned host memory without blocking
+    
+    Args:
+        tensor: Tensor to copy
+        stream: CUDA stream to issue the copy on, so it overlaps with later GPU work
+    
+    Returns:
+        (host_tensor, event) - wait on event before reading host_tensor; event is
+        None when the tensor is not on a CUDA device and needs no copy
+    """
+    if tensor.device.type != 'cuda':
+        return tensor, None
+    
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    stream = stream or torch.cuda.current_stream()
+    # The copy must not start before the kernels producing the tensor have finished
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        host.copy_(tensor, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+    # Keep the caching allocator from reusing the tensor while the copy is in flight
+    tensor.record_stream(stream)
+    return host, event
+
+# Long-lived encode/upload threads shared by all jobs; sized to the Supabase connection pool
+STEM_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="stem-io")
+
+def encode_stem(host_audio: torch.Tensor, copied, sr: int) -> io.BytesIO:
+    """
+    Encode an int16 stem into a buffer in the configured format
+    
+    Args:
+        host_audio: Contiguous stem samples (samples, channels) in host memory
+        copied: Event from copy_to_host to wait on, or None
+        sr: Sample rate of the stem
+    
+    Returns:
+        Encoded stem, rewound to the start
+    """
+    if copied is not None:
+        copied.synchronize()
+    
+    # Demucs stems are already stereo; a mono stem is written as one channel rather than duplicated
+    stem_numpy = host_audio.numpy()
+    
+    # Save to bytes buffer in the configured encoding
+    buffer = io.BytesIO()
+    sf_format, sf_subtype = STEM_FORMATS[STEM_FORMAT][:2]
+    sf.write(buffer, stem_numpy, sr, format=sf_format, subtype=sf_subtype)
+    buffer.seek(0)
+    return buffer
+
+# Read size when streaming downloaded audio to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Downloads land in this directory, created once at start (point it at /dev/shm to keep inputs in RAM)
+SCRATCH_DIR = Path(os.getenv("STEMI_SCRATCH_DIR", Path(tempfile.gettempdir()) / "stemi"))
+SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+
+# Inputs over these limits are rejected before any decode or GPU work
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", 500 * 1024 * 1024))
+MAX_AUDIO_SECONDS = float(os.getenv("MAX_AUDIO_SECONDS", 20 * 60))
+
+def too_long_error(duration: float) -> Union[str, None]:
+    """Describe why audio of this duration is rejected, or return None"""
+    if duration > MAX_AUDIO_SECONDS:
+        return f"Audio too long: {duration:.0f}s (maximum {MAX_AUDIO_SECONDS:.0f}s)"
+    return None
+
+def audio_duration_error(audio_data: Union[bytes, str]) -> Union[str, None]:
+    """
+    Check the duration recorded in the container headers, without decoding the audio
+    
+    torchaudio's FFmpeg info() decodes whole files to count frames when the container
+    doesn't record them (MP3 and most compressed formats); libsndfile reads headers only.
+    Containers it can't open (e.g. MP4) pass here and are measured once decoded.
+    """
+    try:
+        info = sf.info(audio_data if isinstance(audio_data, str) else io.BytesIO(audio_data))
+    except Exception:
+        return None
+    if info.frames and info.samplerate:
+        return too_long_error(info.frames / info.samplerate)
+    return None
+
+# Temp file suffix by Content-Type, so the decoder (and torchaudio.load's fallback) is told the real format
+AUDIO_SUFFIXES = {
+    "audio/mpeg": ".mp3", "audio/mp3": ".mp3",
+    "audio/wav": ".wav", "audio/x-wav": ".wav", "audio/wave": ".wav", "audio/vnd.wave": ".wav",
+    "audio/flac": ".flac", "audio/x-flac": ".flac",
+    "audio/ogg": ".ogg", "audio/opus": ".opus",
+    "audio/mp4": ".m4a", "audio/x-m4a": ".m4a", "audio/aac": ".aac",
+    "audio/webm": ".webm",
+    "audio/aiff": ".aiff", "audio/x-aiff": ".aiff",
+}
+
+def audio_suffix(audio_url: str, content_type: str) -> str:
+    """File suffix for downloaded audio from its Content-Type, else the URL path; empty when neither tells"""
+    suffix = AUDIO_SUFFIXES.get(content_type.split(";")[0].strip().lower())
+    if suffix:
+        return suffix
+    # Storage paths like inputs/{job_id}/source carry no extension
+    return Path(urlparse(audio_url).path).suffix.lower()
+
+def download_audio(audio_url: str) -> str:
+    """
+    Stream audio from a URL straight into a temporary file
+    
+    Args:
+        audio_url: URL of the source audio
+    
+    Returns:
+        Path of the temporary file (the caller owns and removes it), named with
+        the suffix of the audio's format when it is known
+    """
+    with requests.get(audio_url, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        suffix = audio_suffix(audio_url, response.headers.get("Content-Type", ""))
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=SCRATCH_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = 0
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_AUDIO_BYTES:
+                        raise ValueError(f"Audio too large (maximum {MAX_AUDIO_BYTES} bytes)")
+                    f.write(chunk)
+        except Exception:
+            Path(path).unlink(missing_ok=True)
+            raise
+    return path
+
+def decode_audio(source: Union[str, io.BytesIO]):
+    """
+    Decode audio at its native sample rate and channel count
+    
+    FFmpeg's swresample would upmix mono at -3 dB rather than duplicate the channel,
+    so layout and rate are left to the on-device expand and resampler.
+    
+    Args:
+        source: Path or in-memory audio file
+    
+    Returns:
+        (waveform, sample_rate); falls back to torchaudio.load when StreamReader
+        is unavailable
+    """
+    if StreamReader is not None:
+        try:
+            reader = StreamReader(source)
+            sample_rate = int(reader.get_src_stream_info(reader.default_audio_stream).sample_rate)
+            reader.add_basic_audio_stream(frames_per_chunk=-1)
+            reader.process_all_packets()
+            (waveform,) = reader.pop_chunks()
+            # StreamReader yields (frames, channels)
+            return waveform.T.contiguous(), sample_rate
+        except Exception as e:
+            logger.warning(f"StreamReader decode failed, falling back to torchaudio.load: {e}")
+            if not isinstance(source, str):
+                source.seek(0)
+    return torchaudio.load(source)
+
+# Resampling, normalization and quantization around the forward pass need no autograd tracking either
+@torch.inference_mode()
+def separate_stems(audio_data: Union[bytes, str], stems: list, device, model, job_id: str) -> dict:
     """
     Separate audio into stems using Demucs
     
     Args:
-        audio_data: Raw audio file bytes
+        audio_data: Raw audio file bytes, or the path of a temporary audio file
+            that separate_stems takes ownership of (and deletes)
         stems: List of stems to extract
         device: Torch device
+        model: Demucs model already loaded on device
+        job_id: Job ID the stems are stored under
     
     Returns:
-        dict: Base64 encoded stems
+        dict: On success, {"success": True, "job_id", "stem_urls": {stem: public URL of
+        {job_id}/{stem}.{ext} in the stems bucket}, "available_stems", "storage_type":
+        "supabase"}; on failure, {"success": False, "error"}
     """
     # Initialize result variable
     result = {"success": False, "error": "Unknown error"}
     temp_input_path = None
-    temp_demucs_dir = None
     
     try:
-        logger.info("=== SEPARATE_STEMS STARTED ===")
-        logger.info(f"Audio data size: {len(audio_data)} bytes")
-        logger.info(f"Requested stems: {stems}")
-        logger.info(f"Device: {device}")
+        logger.debug("=== SEPARATE_STEMS STARTED ===")
+        logger.debug("Requested stems: %s", stems)
+        logger.debug("Device: %s", device)
         
-        # Create temporary file for input audio
-        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as temp_input:
-            temp_input.write(audio_data)
-            temp_input_path = temp_input.name
+        if isinstance(audio_data, str):
+            # Already on disk (streamed download), decode it from there
+            temp_input_path = audio_data
+            logger.debug("Audio data size: %s bytes", os.path.getsize(temp_input_path))
+            source = temp_input_path
+        else:
+            # Decode straight from memory, no temp file round-trip
+            logger.debug("Audio data size: %s bytes", len(audio_data))
+            source = io.BytesIO(audio_data)
+        waveform, sample_rate = decode_audio(source)
         
-        logger.info(f"Created temp file: {temp_input_path}")
+        # Inputs the header check couldn't measure are rejected here, before any GPU work
+        duration_error = too_long_error(waveform.shape[-1] / sample_rate)
+        if duration_error:
+            raise ValueError(duration_error)
         
-        # Load and preprocess audio
-        waveform, sample_rate = torchaudio.load(temp_input_path)
+        # Copy to the device once; the channel fix-up and resampling run there.
+        # From pinned memory the copy is a queued DMA, so the CPU goes on to launch the kernels after it
+        if device.type == 'cuda':
+            waveform = waveform.pin_memory().to(device, non_blocking=True)
+        else:
+            waveform = waveform.to(device)
         
-        # Convert to mono if stereo
-        if waveform.shape[0] > 1:
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
+        # Drop extra channels first so the resampler only sees the ones Demucs uses
+        if waveform.shape[0] > 2:
+            waveform = waveform[:2]
         
         # Resample if necessary (Demucs expects 44.1kHz)
-        if sample_rate != 44100:
-            resampler = torchaudio.transforms.Resample(sample_rate, 44100)
-            waveform = resampler(waveform)
-            sample_rate = 44100
+        if sample_rate != model.samplerate:
+            waveform = get_resampler(sample_rate, model.samplerate, device)(waveform)
+            sample_rate = model.samplerate
         
-        # Create temporary directory for demucs output
-        temp_demucs_dir = tempfile.mkdtemp()
+        # Demucs models are stereo: duplicate mono input, never downmix. Resampling
+        # happened on the single channel, and expand views it twice without a copy
+        if waveform.shape[0] == 1:
+            waveform = waveform.expand(2, -1)
         
-        # Save original sys.argv and replace with demucs arguments
-        original_argv = sys.argv.copy()
         try:
-            sys.argv = [
-                'demucs.separate',
-                '-n', 'htdemucs_6s',
-                '-d', str(device),
-                '-o', temp_demucs_dir,
-                temp_input_path
-            ]
-            
-            # Run demucs separation
-            logger.info("Running Demucs separation...")
-            demucs.separate.main()
-            logger.info("Demucs separation completed")
-            
-            # Find output files
-            logger.info(f"Searching for output in: {temp_demucs_dir}")
-            song_dirs = glob.glob(os.path.join(temp_demucs_dir, 'htdemucs_6s', '*'))
-            logger.info(f"Found htdemucs_6s dirs: {song_dirs}")
-            
-            if not song_dirs:
-                song_dirs = glob.glob(os.path.join(temp_demucs_dir, 'htdemucs', '*'))
-                logger.info(f"Found htdemucs dirs: {song_dirs}")
-            
-            if not song_dirs:
-                logger.error("No Demucs output directories found")
-                raise ValueError("No Demucs output found")
+            # Run Demucs on the loaded tensor instead of through the CLI and WAV files
+            logger.debug("Running Demucs separation...")
+            # Same normalization demucs.separate applies around apply_model
+            ref = waveform.mean(0)
+            mean, std = ref.mean(), ref.std()
+            normalized = (waveform - mean) / std
+            if BATCHER is not None and model is BATCHER.model:
+                # Shares one forward pass with other jobs running on this worker
+                sources = BATCHER.separate(normalized)
+            else:
+                try:
+                    sources = demucs_forward(model, normalized[None], device)[0]
+                except torch.cuda.OutOfMemoryError:
+                    # Hand the cached blocks back and retry once with the mix and sources in host RAM
+                    logger.warning("Demucs ran out of GPU memory, retrying from host memory")
+                    torch.cuda.empty_cache()
+                    sources = demucs_forward(model, normalized[None], device, offload=True)[0]
+            logger.debug("Demucs separation completed")
             
-            demucs_output_dir = song_dirs[0]
-            logger.info(f"Using output dir: {demucs_output_dir}")
+            # Stems this model separates; the others are never moved or denormalized
+            available_stems = [stem_name for stem_name in model.sources if stem_name in VALID_STEMS]
+            logger.debug("Separated stems: %s", available_stems)
             
-            stem_files = glob.glob(os.path.join(demucs_output_dir, '*.wav'))
-            logger.info(f"Found {len(stem_files)} stem files: {[os.path.basename(f) for f in stem_files]}")
-            
-            # Map stem files to requested stems
-            available_stems = {}
-            for stem_file in stem_files:
-                stem_name = Path(stem_file).stem
-                if stem_name in ['vocals', 'bass', 'drums', 'other', 'guitar', 'piano']:
-                    available_stems[stem_name] = stem_file
+            # Free the mix before encoding; the source stack stays where Demucs left it
+            # (in host RAM for offloaded long tracks) and is read one stem at a time below
+            del waveform, normalized
             
             # Upload requested stems to Supabase and get URLs
-            logger.info("=== PROCESSING STEMS FOR SUPABASE STORAGE ===")
+            logger.debug("=== PROCESSING STEMS FOR SUPABASE STORAGE ===")
             
-            # Debug: Check environment variables
-            supabase_url = os.getenv("SUPABASE_URL")
-            supabase_key = os.getenv("SUPABASE_ANON_KEY")
-            logger.info(f"Environment check - SUPABASE_URL: {'SET' if supabase_url else 'NOT SET'}")
-            logger.info(f"Environment check - SUPABASE_ANON_KEY: {'SET' if supabase_key else 'NOT SET'}")
+            # Worker-wide client, created at startup; a misconfiguration raises here (no fallback)
+            supabase_client = get_supabase_client()
             
-            # Initialize Supabase client (no fallback - must work)
-            try:
-                supabase_client = SupabaseClient()
-                logger.info("Supabase client initialized successfully")
-            except Exception as e:
-                logger.error(f"Supabase client initialization failed: {e}")
-                raise Exception(f"Failed to initialize Supabase client: {e}")
+            extension, content_type = STEM_FORMATS[STEM_FORMAT][2:]
             
-            # Prepare stem buffers for upload
-            stem_buffers = {}
+            def encode_and_upload(stem: str, host_audio: torch.Tensor, copied, sr: int) -> str:
+                buffer = encode_stem(host_audio, copied, sr)
+                logger.debug("Prepared %s stem buffer (%s bytes)", stem, buffer.getbuffer().nbytes)
+                return supabase_client.upload_stem(job_id, stem, buffer, extension, content_type)
+            
+            # Prepare requested stems on the device and start their host copies. Each stem is
+            # handed to an encode/upload thread as soon as its copy is queued, so the first
+            # stems encode and upload while later ones are still being prepared
+            copy_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+            futures = {}
             for stem in stems:
                 if stem in available_stems:
-                    # Read the stem file
-                    stem_audio, sr = torchaudio.load(available_stems[stem])
-                    
-                    # Convert to numpy and ensure stereo
-                    stem_numpy = stem_audio.cpu().numpy()
-                    if stem_numpy.shape[0] == 1:
-                        stem_numpy = np.repeat(stem_numpy, 2, axis=0)
+                    # Bring back and denormalize one stem at a time, so an offloaded long track
+                    # never has more than one full-length stem on the GPU; the host stem is
+                    # pinned first so the copy is a DMA
+                    source = sources[model.sources.index(stem)]
+                    if source.device.type != device.type:
+                        source = source.pin_memory().to(device, non_blocking=True)
+                    # Rescale like the Demucs CLI does before saving, so stems don't clip
+                    stem_audio, sr = rescale_to_unit(source * std + mean), model.samplerate
+                    del source
                     
-                    # Reduce sample rate to save memory (44.1kHz -> 22kHz)
-                    if sr > 22050:
-                        import torchaudio.transforms as T
-                        resampler = T.Resample(sr, 22050)
-                        stem_audio = resampler(stem_audio)
-                        sr = 22050
-                        stem_numpy = stem_audio.cpu().numpy()
-                        if stem_numpy.shape[0] == 1:
-                            stem_numpy = np.repeat(stem_numpy, 2, axis=0)
+                    # Reduce sample rate to save memory (44.1kHz -> 22kHz) on the device,
+                    # so only half the samples are copied to the host
+                    if sr > STEM_SAMPLE_RATE:
+                        stem_audio = get_resampler(sr, STEM_SAMPLE_RATE, device)(stem_audio)
+                        sr = STEM_SAMPLE_RATE
                     
-                    # Save to bytes buffer as WAV
-                    buffer = io.BytesIO()
-                    sf.write(buffer, stem_numpy.T, sr, format='WAV')
-                    buffer.seek(0)
+                    # Quantize to int16 on the device: halves the host copy and soundfile
+                    # writes the PCM_16 samples without converting them. Round like libsndfile
+                    # does; a bare cast truncates toward zero
+                    stem_audio = torch.round(stem_audio.clamp(-1, 1) * 32767).to(torch.int16)
+                    # Interleave to libsndfile's (samples, channels) layout on the device,
+                    # so the host array is written as-is instead of through a strided view
+                    stem_audio = stem_audio.T.contiguous()
                     
-                    # Store buffer for upload
-                    stem_buffers[stem] = buffer
-                    logger.info(f"Prepared {stem} stem buffer ({len(buffer.getvalue())} bytes)")
+                    host_audio, copied = copy_to_host(stem_audio, copy_stream)
+                    futures[stem] = STEM_EXECUTOR.submit(encode_and_upload, stem, host_audio, copied, sr)
+                    # Release this stem's device copy before the next one is moved
+                    del stem_audio
                 else:
                     logger.warning(f"Requested stem '{stem}' not found in output")
             
-            # Generate a unique job ID for this request
-            import uuid
-            job_id = str(uuid.uuid4())
-            logger.info(f"Generated job ID: {job_id}")
+            # Every requested stem is on its way to the host; free the full source stack
+            del sources
+            if device.type == 'cuda':
+                logger.debug("GPU memory allocated after freeing the sources: %s bytes", torch.cuda.memory_allocated(device))
             
             # Upload stems to Supabase (no fallback)
             try:
-                # Upload stems and get URLs
-                stem_urls = supabase_client.upload_stems(job_id, stem_buffers)
-                logger.info(f"Successfully uploaded {len(stem_urls)} stems to Supabase")
+                # Each stem uploads as soon as it is encoded, so encoding (libsndfile releases
+                # the GIL) overlaps with the other stems' network I/O
+                stem_urls = {stem: future.result() for stem, future in futures.items()}
+                logger.info(f"Uploaded {len(stem_urls)} stems to Supabase for job {job_id}")
                 
                 # Return Supabase URLs
                 result = {
                     "success": True,
                     "job_id": job_id,
                     "stem_urls": stem_urls,
-                    "available_stems": list(available_stems.keys()),
+                    "available_stems": available_stems,
                     "storage_type": "supabase"
                 }
                 
@@ -200,36 +740,21 @@ def separate_stems(audio_data: bytes, stems: list, device) -> dict:
                 logger.error(f"Failed to upload stems to Supabase: {e}")
                 raise Exception(f"Supabase upload failed: {e}")
             
-            logger.info(f"=== SEPARATION SUCCESS ===")
-            logger.info(f"Job ID: {job_id}")
-            logger.info(f"Storage type: supabase")
-            logger.info(f"Uploaded stems: {list(result.get('stem_urls', {}).keys())}")
-            logger.info(f"Stem URLs: {result.get('stem_urls', {})}")
-            logger.info(f"Available stems: {result['available_stems']}")
+            logger.debug("=== SEPARATION SUCCESS ===")
+            logger.debug("Job ID: %s", job_id)
+            logger.debug("Storage type: supabase")
+            logger.debug("Uploaded stems: %s", list(result['stem_urls'].keys()))
+            logger.debug("Stem URLs: %s", result['stem_urls'])
+            logger.debug("Available stems: %s", result['available_stems'])
             
             # Return success result immediately
-            logger.info(f"=== RETURNING SUCCESS RESULT ===")
+            logger.debug("=== RETURNING SUCCESS RESULT ===")
             return result
             
         finally:
-            # Restore sys.argv
-            sys.argv = original_argv
-            
-            # Clean up temporary files safely
-            try:
-                if temp_input_path and os.path.exists(temp_input_path):
-                    os.unlink(temp_input_path)
-            except:
-                pass
-            try:
-                if temp_demucs_dir and os.path.exists(temp_demucs_dir):
-                    shutil.rmtree(temp_demucs_dir)
-            except:
-                pass
-            
-            # Clear GPU memory
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            # Clean up the downloaded input, if any
+            if temp_input_path:
+                Path(temp_input_path).unlink(missing_ok=True)
         
         # This point should never be reached if success result was returned
         logger.error(f"=== UNEXPECTED: REACHED END WITHOUT RETURN ===")
@@ -240,13 +765,18 @@ def separate_stems(audio_data: bytes, stems: list, device) -> dict:
     except Exception as e:
         logger.error(f"=== SEPARATION EXCEPTION ===")
         logger.error(f"Exception: {e}")
-        import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
+        # Failures before Demucs ran skip the cleanup below it
+        if temp_input_path:
+            Path(temp_input_path).unlink(missing_ok=True)
+        # Only an OOM warrants handing cached blocks back; elsewhere the cache is reused by the next job
+        if isinstance(e, torch.cuda.OutOfMemoryError):
+            torch.cuda.empty_cache()
         error_result = {
             "success": False,
             "error": str(e)
         }
-        logger.info(f"Returning error result: {error_result}")
+        logger.debug("Returning error result: %s", error_result)
         return error_result
 
 def handler(event):
@@ -256,77 +786,173 @@ def handler(event):
     Expected input format:
     {
         "input": {
-            "audio_file": "base64_encoded_audio_data",
-            "stems": ["vocals", "bass", "drums", "other"]
+            "audio_file": "base64_encoded_audio_data",  # or "audio_url": "https://..."
+            "stems": ["vocals", "bass", "drums", "other"],
+            "model": "htdemucs_6s",  # optional, one of DEMUCS_MODELS
+            "job_id": "..."  # optional UUID the stems are stored under
         }
     }
+    
+    Prefer audio_url for anything but short clips: base64 inflates the payload
+    by a third and is held in memory twice while decoding.
     """
     try:
-        logger.info("=== HANDLER STARTED ===")
-        
-        # Initialize device
-        logger.info("Initializing device...")
-        device = initialize()
-        logger.info(f"Device initialized: {device}")
+        logger.debug("=== HANDLER STARTED ===")
         
         # Get input data
         input_data = event.get("input", {})
-        logger.info(f"Input data keys: {list(input_data.keys())}")
+        logger.debug("Input data keys: %s", list(input_data.keys()))
         
         # Validate input
-        if "audio_file" not in input_data:
-            logger.error("Missing audio_file in input")
-            return {"error": "Missing audio_file in input"}
+        if "audio_file" not in input_data and "audio_url" not in input_data:
+            logger.error("Missing audio_file or audio_url in input")
+            return {"error": "Missing audio_file or audio_url in input"}
         
         # Get stems list (default to all)
-        stems = input_data.get("stems", ["vocals", "bass", "drums", "other"])
-        logger.info(f"Requested stems: {stems}")
+        requested = input_data.get("stems", DEFAULT_STEMS)
+        logger.debug("Requested stems: %s", requested)
         
-        # Decode base64 audio data
+        # Store the stems under the API's job ID so it can find and delete them; older API
+        # deployments don't send one. Only a UUID is accepted, as it becomes a storage path
         try:
-            audio_b64 = input_data["audio_file"]
-            logger.info(f"Audio data length: {len(audio_b64)} characters")
-            audio_data = base64.b64decode(audio_b64)
-            logger.info(f"Decoded audio size: {len(audio_data)} bytes")
-        except Exception as e:
-            logger.error(f"Failed to decode audio data: {e}")
-            return {"error": f"Failed to decode audio data: {str(e)}"}
+            job_id = str(uuid.UUID(input_data["job_id"])) if input_data.get("job_id") else str(uuid.uuid4())
+        except (TypeError, ValueError):
+            return {"error": f"Invalid job_id {input_data['job_id']!r}"}
+        logger.debug("Job ID: %s", job_id)
+        
+        model_name = input_data.get("model", DEMUCS_MODEL_NAME)
+        if model_name not in DEMUCS_MODELS:
+            return {"error": f"Unknown model {model_name} - expected one of {sorted(DEMUCS_MODELS)}"}
+        model = get_loaded_model(model_name)
+        
+        # Validate once up front: drop unknown names and duplicates before any GPU work
+        stems = list(dict.fromkeys(stem for stem in requested if stem in VALID_STEMS and stem in model.sources))
+        unknown = [stem for stem in requested if stem not in stems]
+        if unknown:
+            logger.warning(f"Ignoring unknown stems: {unknown}")
         
-        logger.info(f"Starting stem separation for stems: {stems}")
+        if not stems:
+            return {"error": f"None of the requested stems are available - expected some of {model.sources}"}
+        
+        if "audio_url" in input_data:
+            # Download raw audio from storage straight to disk (no base64 overhead, no in-memory copy)
+            try:
+                audio_data = download_audio(input_data["audio_url"])
+                logger.debug("Downloaded audio to %s", audio_data)
+            except Exception as e:
+                logger.error(f"Failed to download audio: {e}")
+                return {"error": f"Failed to download audio: {str(e)}"}
+        else:
+            # Decode base64 audio data
+            try:
+                audio_b64 = input_data["audio_file"]
+                logger.debug("Audio data length: %s characters", len(audio_b64))
+                # Check the size implied by the base64 length before decoding anything
+                if len(audio_b64) // 4 * 3 > MAX_AUDIO_BYTES:
+                    return {"error": f"Audio too large (maximum {MAX_AUDIO_BYTES} bytes)"}
+                # a2b_base64 reads an ASCII str in place; b64decode would first encode it to a bytes copy
+                audio_data = binascii.a2b_base64(audio_b64)
+                logger.debug("Decoded audio size: %s bytes", len(audio_data))
+            except Exception as e:
+                logger.error(f"Failed to decode audio data: {e}")
+                return {"error": f"Failed to decode audio data: {str(e)}"}
+        
+        duration_error = audio_duration_error(audio_data)
+        if duration_error:
+            if isinstance(audio_data, str):
+                Path(audio_data).unlink(missing_ok=True)
+            logger.warning(f"Rejected input: {duration_error}")
+            return {"error": duration_error}
+        
+        logger.debug("Starting stem separation for stems: %s", stems)
         
         # Perform stem separation
-        result = separate_stems(audio_data, stems, device)
-        logger.info(f"Separation result keys: {list(result.keys()) if isinstance(result, dict) else 'not dict'}")
+        result = separate_stems(audio_data, stems, DEVICE, model, job_id)
+        logger.debug("Separation result keys: %s", list(result.keys()) if isinstance(result, dict) else 'not dict')
         
         if result["success"]:
-            logger.info("=== HANDLER SUCCESS ===")
+            logger.debug("=== HANDLER SUCCESS ===")
             response = {
                 "status": "completed",
                 "stem_urls": result["stem_urls"],
                 "available_stems": result["available_stems"],
                 "storage_type": result["storage_type"]
             }
-            logger.info(f"Final response stem URLs count: {len(result['stem_urls'])}")
-            logger.info(f"Final response keys: {list(response.keys())}")
-            logger.info("=== HANDLER RETURNING SUCCESS ===")
+            logger.debug("Final response stem URLs count: %s", len(result['stem_urls']))
+            logger.debug("Final response keys: %s", list(response.keys()))
+            logger.debug("=== HANDLER RETURNING SUCCESS ===")
             return response
         else:
             logger.error(f"=== HANDLER FAILURE ===")
             logger.error(f"Separation failed: {result['error']}")
             error_response = {"error": result["error"]}
-            logger.info(f"Returning error response: {error_response}")
-            logger.info("=== HANDLER RETURNING ERROR ===")
+            logger.debug("Returning error response: %s", error_response)
+            logger.debug("=== HANDLER RETURNING ERROR ===")
             return error_response
     
     except Exception as e:
         logger.error(f"=== HANDLER EXCEPTION ===")
         logger.error(f"Handler error: {e}")
-        import traceback
         logger.error(f"Handler traceback: {traceback.format_exc()}")
         final_error = {"error": f"Handler error: {str(e)}"}
-        logger.info(f"Returning final error: {final_error}")
-        logger.info("=== HANDLER RETURNING EXCEPTION ===")
+        logger.debug("Returning final error: %s", final_error)
+        logger.debug("=== HANDLER RETURNING EXCEPTION ===")
         return final_error
 
+# Pick the device and load the model once; RunPod keeps the worker warm between jobs
+DEVICE = initialize()
+MODEL = get_loaded_model(DEMUCS_MODEL_NAME)
+# Demucs segments all have the same shape, so let cuDNN benchmark once and keep the fastest algorithms
+torch.backends.cudnn.benchmark = True
+
+def warm_up(model, device):
+    """
+    Run silence through Demucs so cuDNN autotuning, the allocator and any compile happen before the first job
+    
+    One pass per batch size the batcher can form, so CUDA graphs are captured for every
+    segment batch shape live jobs will use, before any job runs alongside the capture.
+    """
+    if device.type != 'cuda':
+        return
+    logger.info("Warming up Demucs...")
+    graph_forwards = [sub_model.forward for sub_model in sub_models(model)
+                      if isinstance(sub_model.forward, CUDAGraphForward)]
+    for forward in graph_forwards:
+        forward.capturing = True
+    try:
+        for batch in range(1, max(DEMUCS_MAX_BATCH, 1) + 1):
+            mix = torch.zeros(batch, model.audio_channels, model.samplerate, device=device)
+            demucs_forward(model, mix, device)
+    finally:
+        for forward in graph_forwards:
+            forward.capturing = False
+    torch.cuda.synchronize()
+    logger.info("Demucs warm-up completed")
+
+# Set STEMI_WARMUP=false to trade a slower first job for a faster worker start (no CUDA graphs are captured then)
+if os.getenv("STEMI_WARMUP", "true").lower() == "true":
+    warm_up(MODEL, DEVICE)
+
+# Create the Supabase client (and its connection pool) once, before the first job
+try:
+    get_supabase_client()
+except ValueError as e:
+    logger.error(f"Supabase client not configured, jobs will fail until it is: {e}")
+# Build the resamplers nearly every job needs (48 kHz uploads, stem downsampling) before the first request
+for orig_freq, new_freq in [(48000, MODEL.samplerate), (MODEL.samplerate, STEM_SAMPLE_RATE)]:
+    get_resampler(orig_freq, new_freq, DEVICE)
+
+BATCHER = DemucsBatcher(MODEL, DEVICE, DEMUCS_MAX_BATCH, DEMUCS_BATCH_WINDOW) if DEMUCS_MAX_BATCH > 1 else None
+
+async def async_handler(event):
+    """Run the blocking handler in a thread so several jobs can be in flight for batching"""
+    return await asyncio.to_thread(handler, event)
+
 # Initialize RunPod serverless
-runpod.serverless.start({"handler": handler})
+if BATCHER is not None:
+    runpod.serverless.start({
+        "handler": async_handler,
+        "concurrency_modifier": lambda current_concurrency: DEMUCS_MAX_BATCH
+    })
+else:
+    runpod.serverless.start({"handler": handler})
@@ -0,0 +1,36 @@
+"""
+Standalone RunPod job status sync worker
+Polls RunPod in its own process so API request load cannot delay status updates
+
+Run the API with RUNPOD_SYNC_MODE=external and start this next to it:
+    python runpod_sync.py
+"""
+import asyncio
+import logging
+
+import main
+
+logger = logging.getLogger(__name__)
+
+async def run():
+    """Initialize clients and run the sync loop until cancelled"""
+    main.init_services()
+
+    if not main.runpod_client:
+        logger.error("RunPod client not available - check RUNPOD_API_KEY and RUNPOD_ENDPOINT_ID")
+        return
+
+    # The lock keeps a second sync worker (or an inline API poller) from double-polling
+    if not main.acquire_poller_lock():
+        logger.error(f"Another process already holds the poller lock at {main.POLLER_LOCK_PATH}")
+        return
+    main.is_poller = True
+
+    logger.info("RunPod sync worker started")
+    try:
+        await main.sync_runpod_jobs()
+    finally:
+        await main.runpod_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -5,6 +5,8 @@ Automatically detects current port mappings and instance details.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 import os
 import json
@@ -15,22 +17,30 @@ class VastInstanceDetector:
         self.api_key = api_key
         self.instance_id = instance_id
         self.base_url = "https://console.vast.ai/api/v0"
+        # Instance info fetched once and shared by every port lookup
+        self._cache = None
+        
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        })
+        self.session.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3)))
         
     def get_instance_info(self) -> Optional[Dict]:
-        """Get instance information from Vast.ai API"""
+        """Get instance information from Vast.ai API (cached after the first successful call)"""
+        if self._cache is not None:
+            return self._cache
+        
         try:
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/instances/{self.instance_id}",
-                headers=headers
+                timeout=(5, 10)
             )
             
             if response.status_code == 200:
-                return response.json()
+                self._cache = response.json()
+                return self._cache
             else:
                 print(f"API Error: {response.status_code} - {response.text}")
                 return None
@@ -54,25 +64,20 @@ class VastInstanceDetector:
             public_ip = instance_info.get('public_ipaddr')
             port_mappings = instance_info.get('ports', {})
             
-            # Look for our target internal port
+            # Index the published ports once: internal port -> external port (first mapping wins)
+            by_private = {}
             for mapping in port_mappings:
-                if mapping.get('HostPort') and mapping.get('PrivatePort') == target_internal_port:
-                    external_port = int(mapping['HostPort'])
-                    return (public_ip, external_port, target_internal_port)
+                if mapping.get('HostPort') and mapping.get('PrivatePort'):
+                    by_private.setdefault(mapping['PrivatePort'], int(mapping['HostPort']))
             
-            # If target port not found, look for common web ports
-            web_ports = [8080, 8000, 8888, 5000, 3000]
-            for web_port in web_ports:
-                for mapping in port_mappings:
-                    if mapping.get('PrivatePort') == web_port:
-                        external_port = int(mapping['HostPort'])
-                        return (public_ip, external_port, web_port)
+            # Our target internal port first, then common web ports
+            for port in (target_internal_port, 8080, 8000, 8888, 5000, 3000):
+                if port in by_private:
+                    return (public_ip, by_private[port], port)
             
             # Return first available HTTP-like port
-            for mapping in port_mappings:
-                private_port = mapping.get('PrivatePort')
-                if private_port and private_port > 3000:  # Avoid system ports
-                    external_port = int(mapping['HostPort'])
+            for private_port, external_port in by_private.items():
+                if private_port > 3000:  # Avoid system ports
                     return (public_ip, external_port, private_port)
                     
             return None
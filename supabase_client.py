@@ -3,13 +3,23 @@ Supabase client using only requests
 Specifically designed for RunPod environment to avoid heavy dependencies
 """
 import os
+import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from typing import Dict, BinaryIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, BinaryIO, Union
+from urllib.parse import urljoin
 import io
 
 logger = logging.getLogger(__name__)
 
+# Stems larger than this go through the resumable (TUS) endpoint
+RESUMABLE_UPLOAD_THRESHOLD = 20 * 1024 * 1024
+# Supabase requires every TUS chunk except the last to be exactly 6 MiB
+RESUMABLE_CHUNK_SIZE = 6 * 1024 * 1024
+
 class SupabaseClient:
     def __init__(self):
         self.supabase_url = os.getenv("SUPABASE_URL")
@@ -19,37 +29,57 @@ class SupabaseClient:
         if not self.supabase_url or not self.supabase_key:
             raise ValueError("SUPABASE_URL and SUPABASE_ANON_KEY environment variables are required")
         
-        # Build storage API URL
+        # Build storage API URLs
         self.storage_url = f"{self.supabase_url}/storage/v1/object/{self.bucket_name}"
+        self.resumable_url = f"{self.supabase_url}/storage/v1/upload/resumable"
         
         # Headers for requests
         self.headers = {
             "Authorization": f"Bearer {self.supabase_key}",
             "apikey": self.supabase_key,
+            # Stems are already compressed audio; don't negotiate gzip for storage traffic
+            "Accept-Encoding": "identity",
         }
         
+        # Persistent session so keep-alive connections are reused across stem uploads;
+        # sized for several batched jobs uploading at once, so no connection is dropped
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
         logger.info("Lightweight Supabase client initialized successfully")
 
-    def upload_file(self, file_path: str, file_data: bytes, content_type: str = "audio/wav") -> str:
+    def upload_file(self, file_path: str, file_data: Union[bytes, BinaryIO], content_type: str = "audio/wav") -> str:
         """
         Upload a file to Supabase storage and return public URL
         
         Args:
             file_path: Storage path (e.g., "job_id/vocals.wav")
-            file_data: Binary file data
+            file_data: Binary file data or a file-like object (streamed, not copied)
             content_type: MIME type
             
         Returns:
             Public URL of uploaded file
         """
         try:
-            # Upload file
-            upload_headers = self.headers.copy()
-            upload_headers["Content-Type"] = content_type
+            # Upload file (auth headers are already set on the session)
+            request_headers = {"Content-Type": content_type}
+            if not isinstance(file_data, (bytes, bytearray)):
+                # Explicit length keeps the body non-chunked while streaming from the file
+                position = file_data.tell()
+                size = file_data.seek(0, io.SEEK_END) - position
+                file_data.seek(position)
+                request_headers["Content-Length"] = str(size)
             
-            response = requests.post(
+            response = self.session.post(
                 self.storage_url + "/" + file_path,
-                headers=upload_headers,
+                headers=request_headers,
                 data=file_data,
                 timeout=60
             )
@@ -57,7 +87,7 @@ class SupabaseClient:
             if response.status_code in [200, 201]:
                 # Return public URL
                 public_url = f"{self.supabase_url}/storage/v1/object/public/{self.bucket_name}/{file_path}"
-                logger.info(f"Successfully uploaded to: {public_url}")
+                logger.debug("Successfully uploaded to: %s", public_url)
                 return public_url
             else:
                 logger.error(f"Upload failed with status {response.status_code}: {response.text}")
@@ -67,13 +97,127 @@ class SupabaseClient:
             logger.error(f"Error uploading file {file_path}: {e}")
             raise
 
-    def upload_stems(self, job_id: str, stem_buffers: Dict[str, io.BytesIO]) -> Dict[str, str]:
+    def upload_file_resumable(self, file_path: str, file_data: Union[bytes, BinaryIO],
+                              content_type: str = "audio/wav", max_attempts: int = 3) -> str:
+        """
+        Upload a large file through Supabase's resumable (TUS) endpoint and return public URL
+        
+        The file is sent in RESUMABLE_CHUNK_SIZE pieces; a failed chunk asks the
+        server for its current offset and resumes from there instead of
+        restarting the whole transfer.
+        
+        Args:
+            file_path: Storage path (e.g., "job_id/vocals.wav")
+            file_data: Binary file data or a seekable file-like object
+            content_type: MIME type
+            max_attempts: Chunk failures tolerated before giving up
+            
+        Returns:
+            Public URL of uploaded file
+        """
+        if isinstance(file_data, (bytes, bytearray)):
+            file_data = io.BytesIO(file_data)
+        
+        start = file_data.tell()
+        file_data.seek(0, io.SEEK_END)
+        total_size = file_data.tell() - start
+        
+        def encode(value: str) -> str:
+            return base64.b64encode(value.encode("utf-8")).decode("ascii")
+        
+        tus_headers = {"Tus-Resumable": "1.0.0"}
+        
+        try:
+            # Create the upload session
+            response = self.session.post(
+                self.resumable_url,
+                headers={
+                    **tus_headers,
+                    "Upload-Length": str(total_size),
+                    "Upload-Metadata": ",".join([
+                        f"bucketName {encode(self.bucket_name)}",
+                        f"objectName {encode(file_path)}",
+                        f"contentType {encode(content_type)}",
+                    ]),
+                },
+                timeout=60
+            )
+            
+            if response.status_code != 201 or "Location" not in response.headers:
+                logger.error(f"Resumable upload creation failed with status {response.status_code}: {response.text}")
+                raise Exception(f"Resumable upload creation failed: {response.status_code} - {response.text}")
+            
+            upload_url = urljoin(self.resumable_url, response.headers["Location"])
+            
+            # Send chunks, resuming from the server offset on failure
+            patch_headers = {**tus_headers, "Content-Type": "application/offset+octet-stream"}
+            offset = 0
+            failures = 0
+            while offset < total_size:
+                file_data.seek(start + offset)
+                chunk = file_data.read(RESUMABLE_CHUNK_SIZE)
+                
+                try:
+                    patch_headers["Upload-Offset"] = str(offset)
+                    response = self.session.patch(
+                        upload_url,
+                        headers=patch_headers,
+                        data=chunk,
+                        timeout=60
+                    )
+                    if response.status_code != 204:
+                        raise Exception(f"Chunk upload failed: {response.status_code} - {response.text}")
+                    offset = int(response.headers["Upload-Offset"])
+                    
+                except Exception as e:
+                    failures += 1
+                    if failures >= max_attempts:
+                        raise
+                    logger.warning(f"Chunk at offset {offset} of {file_path} failed ({e}), resuming")
+                    head = self.session.head(upload_url, headers=tus_headers, timeout=30)
+                    offset = int(head.headers.get("Upload-Offset", offset))
+            
+            public_url = f"{self.supabase_url}/storage/v1/object/public/{self.bucket_name}/{file_path}"
+            logger.debug("Successfully uploaded (resumable) to: %s", public_url)
+            return public_url
+            
+        except Exception as e:
+            logger.error(f"Error uploading file {file_path} (resumable): {e}")
+            raise
+
+    def upload_stem(self, job_id: str, stem_name: str, buffer: io.BytesIO,
+                    extension: str = "wav", content_type: str = "audio/wav") -> str:
+        """
+        Upload one stem, resumably when it is large, and return its public URL
+        
+        Args:
+            job_id: Unique job identifier
+            stem_name: Stem name, used as the file name
+            buffer: BytesIO buffer with the encoded stem
+            extension: File extension of the encoded stem
+            content_type: MIME type of the encoded stem
+            
+        Returns:
+            Public URL of uploaded stem
+        """
+        file_path = f"{job_id}/{stem_name}.{extension}"
+        buffer.seek(0)
+        size = len(buffer.getbuffer())
+        logger.debug("Uploading %s: %s bytes", stem_name, size)
+        
+        upload = self.upload_file_resumable if size > RESUMABLE_UPLOAD_THRESHOLD else self.upload_file
+        return upload(file_path, buffer, content_type)
+
+    def upload_stems(self, job_id: str, stem_buffers: Dict[str, io.BytesIO],
+                     extension: str = "wav", content_type: str = "audio/wav") -> Dict[str, str]:
         """
         Upload multiple stems and return their URLs
         
         Args:
             job_id: Unique job identifier
             stem_buffers: Dict of stem_name -> BytesIO buffer
+            extension: File extension of the encoded stems
+            content_type: MIME type of the encoded stems
             
         Returns:
             Dict of stem_name -> public_url
@@ -82,18 +226,24 @@ class SupabaseClient:
         
         logger.info(f"Starting upload of {len(stem_buffers)} stems for job {job_id}")
         
-        for stem_name, buffer in stem_buffers.items():
-            file_path = f"{job_id}/{stem_name}.wav"
-            file_data = buffer.getvalue()
-            logger.info(f"Uploading {stem_name}: {len(file_data)} bytes")
+        if not stem_buffers:
+            return uploaded_urls
+        
+        # Uploads are independent network I/O, so run them concurrently over the pooled session
+        with ThreadPoolExecutor(max_workers=len(stem_buffers)) as executor:
+            futures = {}
+            for stem_name, buffer in stem_buffers.items():
+                futures[executor.submit(self.upload_stem, job_id, stem_name, buffer, extension, content_type)] = stem_name
             
-            try:
-                public_url = self.upload_file(file_path, file_data, "audio/wav")
-                uploaded_urls[stem_name] = public_url
-                logger.info(f"✅ Uploaded {stem_name}: {public_url}")
-            except Exception as e:
-                logger.error(f"❌ Failed to upload {stem_name}: {e}")
-                raise
+            for future in as_completed(futures):
+                stem_name = futures[future]
+                try:
+                    public_url = future.result()
+                    uploaded_urls[stem_name] = public_url
+                    logger.debug("✅ Uploaded %s: %s", stem_name, public_url)
+                except Exception as e:
+                    logger.error(f"❌ Failed to upload {stem_name}: {e}")
+                    raise
         
         logger.info(f"✅ All uploads completed: {list(uploaded_urls.keys())}")
         
@@ -2,136 +2,277 @@
 """
 Supabase integration for storing processed stems
 """
+import functools
+import io
 import os
 import uuid
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, ClassVar, Dict, List, Optional, Set
 import logging
 from supabase import create_client, Client
 import httpx
 
 logger = logging.getLogger(__name__)
 
+# Content types of the stem encodings stored in the bucket, by file extension
+STEM_CONTENT_TYPES = {"wav": "audio/wav", "flac": "audio/flac", "mp3": "audio/mpeg"}
+# Lifetime in seconds of the signed URL RunPod downloads a job's source audio from;
+# it must outlast the job's wait in the RunPod queue
+INPUT_URL_TTL = int(os.getenv("INPUT_URL_TTL", 3600))
+
+def _enable_http2(client: Client):
+    """
+    Swap the storage API's HTTP/1.1 session for an HTTP/2 keep-alive one
+    
+    supabase-py does not expose the storage transport in every version, so this
+    is best effort: when the session is not where expected the default is kept.
+    """
+    storage = client.storage
+    session = getattr(storage, "_client", None)
+    if not isinstance(session, httpx.Client):
+        logger.debug("Supabase storage session not found, keeping the default HTTP client")
+        return
+    
+    storage._client = httpx.Client(
+        base_url=session.base_url,
+        # Audio doesn't compress; skip gzip negotiation on storage traffic
+        headers={**session.headers, "Accept-Encoding": "identity"},
+        timeout=session.timeout,
+        follow_redirects=session.follow_redirects,
+        # Concurrent stem uploads multiplex over one connection that outlives each job
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60)
+        )
+    )
+    if getattr(storage, "session", None) is session:
+        storage.session = storage._client
+    session.close()
+
+@functools.lru_cache(maxsize=4)
+def _create_client(supabase_url: str, supabase_key: str) -> Client:
+    """One Supabase client (and HTTP connection pool) per project and key"""
+    client = create_client(supabase_url, supabase_key)
+    _enable_http2(client)
+    return client
+
 class SupabaseStemStorage:
-    def __init__(self, supabase_url: str = None, supabase_key: str = None, bucket_name: str = "stems"):
+    # Buckets already checked by this process, so further storages skip the check
+    _bucket_checked: ClassVar[Set[str]] = set()
+    
+    def __init__(self, supabase_url: str = None, supabase_key: str = None, bucket_name: str = "stems",
+                 input_bucket_name: str = None):
         self.supabase_url = supabase_url or os.getenv("SUPABASE_URL")
         # Support both old anon key and new service role key
         self.supabase_key = (supabase_key or 
                             os.getenv("SUPABASE_ANON_KEY"))
         self.bucket_name = bucket_name
+        # Source audio goes to a private bucket when one is configured. Otherwise it shares the
+        # public stems bucket and is readable at its public URL until the job finishes
+        self.input_bucket_name = input_bucket_name or os.getenv("SUPABASE_INPUT_BUCKET") or bucket_name
         
         if not self.supabase_url or not self.supabase_key:
             raise ValueError("Supabase URL and service role key are required")
         
-        # Initialize Supabase client
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+        # Initialize Supabase client, shared with other storages for the same project
+        self.supabase: Client = _create_client(self.supabase_url, self.supabase_key)
+        # The bucket is public, so object URLs follow a fixed template
+        self.public_base_url = f"{self.supabase_url.rstrip('/')}/storage/v1/object/public/{self.bucket_name}"
         
         # Ensure bucket exists
         self._ensure_bucket_exists()
     
     def _ensure_bucket_exists(self):
         """Ensure the bucket exists - since uploads work, we'll assume it exists"""
+        if self.bucket_name in self._bucket_checked:
+            return
+        self._bucket_checked.add(self.bucket_name)
+        
         # Skip bucket metadata checks since they fail with anon key
         # but uploads work fine to the public 'stems' bucket
         logger.info(f"Assuming bucket '{self.bucket_name}' exists (public bucket)")
     
+    def public_url(self, storage_path: str) -> str:
+        """Public URL of an object in the bucket, built without going through the SDK"""
+        return f"{self.public_base_url}/{storage_path}"
+    
+    def _upload_concurrently(self, upload: Callable, stem_files: Dict) -> Dict[str, str]:
+        """Run upload(stem_name, item) for every stem at once; uploads are independent network I/O"""
+        public_urls = {}
+        if not stem_files:
+            return public_urls
+        
+        with ThreadPoolExecutor(max_workers=len(stem_files)) as executor:
+            futures = {executor.submit(upload, stem_name, item): stem_name for stem_name, item in stem_files.items()}
+            for future in as_completed(futures):
+                stem_name = futures[future]
+                try:
+                    public_urls[stem_name] = future.result()
+                except Exception as e:
+                    logger.error(f"Error uploading {stem_name}: {e}")
+                    raise
+        
+        return public_urls
+    
     def upload_stems(self, job_id: str, stem_files: Dict[str, str]) -> Dict[str, str]:
         """
         Upload processed stems to Supabase storage
         
         Args:
             job_id: Unique job identifier
-            stem_files: Dict of {stem_name: file_path}
+            stem_files: Dict of {stem_name: file_path}; each file keeps its own
+                extension (wav, flac or mp3) in storage
             
         Returns:
             Dict of {stem_name: public_url}
         """
-        public_urls = {}
-        
-        for stem_name, file_path in stem_files.items():
-            try:
-                # Generate storage path
-                storage_path = f"{job_id}/{stem_name}.wav"
-                
-                # Upload file to Supabase
-                with open(file_path, "rb") as f:
-                    result = self.supabase.storage.from_(self.bucket_name).upload(
-                        storage_path,
-                        f.read(),
-                        file_options={
-                            "content-type": "audio/wav",
-                            "cache-control": "3600"
-                        }
-                    )
-                
-                # Check if upload was successful (no error means success)
-                if hasattr(result, 'error') and result.error:
-                    raise Exception(f"Upload error: {result.error}")
-                
-                # Get public URL
-                public_url = self.supabase.storage.from_(self.bucket_name).get_public_url(storage_path)
-                public_urls[stem_name] = public_url
-                
-                logger.info(f"Uploaded {stem_name} to Supabase: {storage_path}")
-                
-            except Exception as e:
-                logger.error(f"Error uploading {stem_name}: {e}")
-                raise
+        def upload(stem_name: str, file_path: str) -> str:
+            # Generate storage path from the source file's encoding
+            extension = os.path.splitext(file_path)[1].lstrip(".").lower() or "wav"
+            storage_path = f"{job_id}/{stem_name}.{extension}"
+            
+            # Upload file to Supabase; given the open file, the SDK streams it instead of holding its bytes
+            with open(file_path, "rb") as f:
+                result = self.supabase.storage.from_(self.bucket_name).upload(
+                    storage_path,
+                    f,
+                    file_options={
+                        "content-type": STEM_CONTENT_TYPES.get(extension, "application/octet-stream"),
+                        "cache-control": "3600"
+                    }
+                )
+            
+            # Check if upload was successful (no error means success)
+            if hasattr(result, 'error') and result.error:
+                raise Exception(f"Upload error: {result.error}")
+            
+            logger.info(f"Uploaded {stem_name} to Supabase: {storage_path}")
+            # Public URLs are built locally, no second round-trip
+            return self.public_url(storage_path)
         
-        return public_urls
+        return self._upload_concurrently(upload, stem_files)
     
-    def upload_stems_from_bytes(self, job_id: str, stem_files: Dict[str, 'io.BytesIO']) -> Dict[str, str]:
+    def upload_stems_from_bytes(self, job_id: str, stem_files: Dict[str, 'io.BytesIO'],
+                                extension: str = "wav") -> Dict[str, str]:
         """
         Upload processed stems from BytesIO objects to Supabase storage
         
         Args:
             job_id: Unique job identifier
-            stem_files: Dict of {stem_name: BytesIO_object}
+            stem_files: Dict of {stem_name: BytesIO_object} (any seekable binary file works)
+            extension: File extension of the encoded stems (a key of STEM_CONTENT_TYPES)
             
         Returns:
             Dict of {stem_name: public_url}
         """
-        import io
-        public_urls = {}
+        content_type = STEM_CONTENT_TYPES[extension]
         
-        for stem_name, stem_buffer in stem_files.items():
-            try:
-                # Generate storage path
-                storage_path = f"{job_id}/{stem_name}.wav"
-                
-                # Upload file to Supabase
-                result = self.supabase.storage.from_(self.bucket_name).upload(
-                    file=stem_buffer.getvalue(),
+        def upload(stem_name: str, stem_buffer: 'io.BytesIO') -> str:
+            # Generate storage path
+            storage_path = f"{job_id}/{stem_name}.{extension}"
+            
+            # Upload file to Supabase; open files are streamed, in-memory buffers sent as bytes
+            stem_buffer.seek(0)
+            data = stem_buffer if isinstance(stem_buffer, io.BufferedReader) else stem_buffer.read()
+            result = self.supabase.storage.from_(self.bucket_name).upload(
+                file=data,
+                path=storage_path,
+                file_options={"content-type": content_type}
+            )
+            
+            if not result.data:
+                logger.error(f"Supabase upload failed for {stem_name}: {result.error}")
+                raise Exception(f"Upload failed: {result.error}")
+            
+            logger.info(f"Uploaded {stem_name} to Supabase: {storage_path}")
+            return self.public_url(storage_path)
+        
+        return self._upload_concurrently(upload, stem_files)
+    
+    def upload_input(self, job_id: str, audio_file: 'BinaryIO', content_type: str = "audio/mpeg") -> str:
+        """
+        Upload a source audio file so the RunPod worker can fetch it by URL
+        
+        Args:
+            job_id: Unique job identifier
+            audio_file: Binary file object (e.g. an upload's spooled file) positioned
+                at the start of the audio
+            content_type: MIME type of the audio
+            
+        Returns:
+            Signed URL of the uploaded audio, valid for INPUT_URL_TTL seconds
+        """
+        storage_path = self.input_path(job_id)
+        
+        try:
+            # storage3 only streams BufferedReaders and reads anything else into memory;
+            # a reader over the file's descriptor (fileno() rolls a spooled file to disk)
+            # lets httpx send the upload in chunks
+            with open(audio_file.fileno(), "rb", closefd=False) as stream:
+                stream.seek(audio_file.tell())
+                self.supabase.storage.from_(self.input_bucket_name).upload(
+                    file=stream,
                     path=storage_path,
-                    file_options={"content-type": "audio/wav"}
+                    file_options={"content-type": content_type}
                 )
-                
-                if result.data:
-                    # Get public URL
-                    public_url = self.supabase.storage.from_(self.bucket_name).get_public_url(storage_path)
-                    public_urls[stem_name] = public_url
-                    logger.info(f"Uploaded {stem_name} to Supabase: {storage_path}")
-                else:
-                    logger.error(f"Supabase upload failed for {stem_name}: {result.error}")
-                    raise Exception(f"Upload failed: {result.error}")
-                    
-            except Exception as e:
-                logger.error(f"Error uploading {stem_name}: {e}")
-                raise
+            
+            # An expiring URL works for a private input bucket; in the public bucket the
+            # object is also readable at its public URL until delete_input removes it
+            signed_url = self.get_signed_url(storage_path, INPUT_URL_TTL, self.input_bucket_name)
+            logger.info(f"Uploaded input audio to Supabase: {storage_path}")
+            return signed_url
+            
+        except Exception as e:
+            logger.error(f"Error uploading input audio for job {job_id}: {e}")
+            raise
+    
+    def input_path(self, job_id: str) -> str:
+        """Storage path of a job's source audio"""
+        return f"inputs/{job_id}/source"
+    
+    def delete_input(self, job_id: str):
+        """
+        Delete a job's source audio once the worker no longer needs it
         
-        return public_urls
+        Args:
+            job_id: Unique job identifier
+        """
+        try:
+            # Jobs submitted without storage have no input object; removing a missing path is a no-op
+            self.supabase.storage.from_(self.input_bucket_name).remove([self.input_path(job_id)])
+            logger.info(f"Deleted input audio for job {job_id}")
+        except Exception as e:
+            logger.error(f"Error deleting input audio for job {job_id}: {e}")
+            raise
     
-    def get_stem_urls(self, job_id: str) -> Dict[str, str]:
-        """Get public URLs for all stems in a job"""
+    def get_stem_urls(self, job_id: str, stem_names: Optional[List[str]] = None,
+                      extension: str = "wav") -> Dict[str, str]:
+        """
+        Get public URLs for all stems in a job
+        
+        Args:
+            job_id: Unique job identifier
+            stem_names: Stems the job produced; when given, their URLs are built
+                with extension and no listing is made
+            extension: File extension of the stems when stem_names is given
+        
+        Returns:
+            Dict of {stem_name: public_url}
+        """
+        if stem_names:
+            return {stem: self.public_url(f"{job_id}/{stem}.{extension}") for stem in stem_names}
+        
         try:
             # List files in the job directory
             files = self.supabase.storage.from_(self.bucket_name).list(f"{job_id}/")
             
             stem_urls = {}
             for file_info in files:
-                if file_info["name"].endswith(".wav"):
-                    stem_name = file_info["name"].replace(".wav", "")
+                stem_name, extension = os.path.splitext(file_info["name"])
+                if extension.lstrip(".") in STEM_CONTENT_TYPES:
                     storage_path = f"{job_id}/{file_info['name']}"
-                    public_url = self.supabase.storage.from_(self.bucket_name).get_public_url(storage_path)
+                    public_url = self.public_url(storage_path)
                     stem_urls[stem_name] = public_url
             
             return stem_urls
@@ -140,14 +281,25 @@ class SupabaseStemStorage:
             logger.error(f"Error getting stem URLs for job {job_id}: {e}")
             raise
     
-    def delete_stems(self, job_id: str):
-        """Delete all stems for a job"""
+    def delete_stems(self, job_id: str, stem_urls: Optional[Dict[str, str]] = None):
+        """
+        Delete all stems for a job
+        
+        Args:
+            job_id: Unique job identifier
+            stem_urls: Public URLs of the job's stems ({stem_name: url}); when given,
+                the objects are deleted by the paths in their URLs instead of
+                listing the job directory first
+        """
         try:
-            # List files in the job directory
-            files = self.supabase.storage.from_(self.bucket_name).list(f"{job_id}/")
+            if stem_urls:
+                file_paths = [self.storage_path(url) for url in stem_urls.values()]
+            else:
+                # List files in the job directory
+                files = self.supabase.storage.from_(self.bucket_name).list(f"{job_id}/")
+                file_paths = [f"{job_id}/{file_info['name']}" for file_info in files]
             
             # Delete all files
-            file_paths = [f"{job_id}/{file_info['name']}" for file_info in files]
             if file_paths:
                 self.supabase.storage.from_(self.bucket_name).remove(file_paths)
                 
@@ -157,17 +309,57 @@ class SupabaseStemStorage:
             logger.error(f"Error deleting stems for job {job_id}: {e}")
             raise
     
-    def get_signed_url(self, storage_path: str, expires_in: int = 3600) -> str:
-        """Get a signed URL for private access"""
+    def storage_path(self, url: str) -> str:
+        """Path within the bucket of an object's public or signed URL"""
+        path = url.split("?", 1)[0]
+        for prefix in (f"/object/public/{self.bucket_name}/", f"/object/sign/{self.bucket_name}/"):
+            if prefix in path:
+                return path.split(prefix, 1)[1]
+        raise ValueError(f"Not a URL of bucket '{self.bucket_name}': {url}")
+    
+    def get_signed_url(self, storage_path: str, expires_in: int = 3600, bucket_name: str = None) -> str:
+        """Get a signed URL for private access (to the stems bucket unless bucket_name is given)"""
         try:
-            signed_url = self.supabase.storage.from_(self.bucket_name).create_signed_url(
+            signed = self.supabase.storage.from_(bucket_name or self.bucket_name).create_signed_url(
                 storage_path,
                 expires_in
             )
-            return signed_url
+            # Older SDK releases spell the key signedURL, newer ones signedUrl
+            return signed.get("signedURL") or signed.get("signedUrl")
         except Exception as e:
             logger.error(f"Error creating signed URL: {e}")
             raise
+    
+    def get_signed_urls(self, storage_paths: List[str], expires_in: int = 3600) -> Dict[str, str]:
+        """
+        Get signed URLs for several objects in one request
+        
+        Args:
+            storage_paths: Storage paths (e.g., ["job_id/vocals.wav", "job_id/bass.wav"])
+            expires_in: Lifetime of the URLs in seconds
+            
+        Returns:
+            Dict of {storage_path: signed_url}
+        """
+        try:
+            signed = self.supabase.storage.from_(self.bucket_name).create_signed_urls(
+                storage_paths,
+                expires_in
+            )
+            # Older SDK releases spell the key signedURL, newer ones signedUrl
+            return {
+                item["path"]: item.get("signedURL") or item.get("signedUrl")
+                for item in signed
+                if not item.get("error")
+            }
+        except Exception as e:
+            logger.error(f"Error creating signed URLs: {e}")
+            raise
+
+@functools.lru_cache(maxsize=1)
+def get_storage() -> SupabaseStemStorage:
+    """Return the process-wide stem storage configured from the environment"""
+    return SupabaseStemStorage()
 
 # Example usage
 def process_and_store_stems(audio_file_path: str, job_id: str) -> Dict[str, str]:
@@ -178,7 +370,7 @@ def process_and_store_stems(audio_file_path: str, job_id: str) -> Dict[str, str]
     # stem_files = separate_stems(audio_file_path)
     
     # 2. Upload to Supabase
-    supabase_storage = SupabaseStemStorage()
+    supabase_storage = get_storage()
     public_urls = supabase_storage.upload_stems(job_id, stem_files)
     
     # 3. Clean up local files